@@ -1,4 +1,3 @@
-import asyncio
 import datetime
 import pytz
 from pytimeparse.timeparse import timeparse
@@ -7,7 +6,7 @@ import discord
 from discord import app_commands
 from discord.ext import commands
 
-from utils import customchecks, sql, punishmentshelper
+from utils import customchecks, guildsettings, sql, punishmentshelper
 from utils.punishmentshelper import lazily_fetch_member
 
 class Confirm(discord.ui.View):
@@ -50,8 +49,8 @@ class AdminCommands(commands.Cog):
         """
         Lists the moderator roles defined for this server.
         """
-        roleIDs = await sql.fetch("SELECT roleid FROM modroles WHERE serverid=?", str(ctx.message.guild.id))
-        modroles = [ctx.message.guild.get_role(int(roleid)).name for roleid in [int(roleID[0]) for roleID in roleIDs]]
+        roleIDs = guildsettings.get(ctx.message.guild.id).modroles
+        modroles = [ctx.message.guild.get_role(roleID).name for roleID in roleIDs]
         if modroles:
             em = discord.Embed(title=f"Defined mod roles for {ctx.message.guild.name}",
                                description=", ".join(modroles),
@@ -68,9 +67,9 @@ class AdminCommands(commands.Cog):
         """
         Add a new moderator role to the defined ones.
         """
-        roleIDs = [int(roleID[0]) for roleID in await sql.fetch("SELECT roleid FROM modroles WHERE serverid=?", str(ctx.message.guild.id))]
+        roleIDs = guildsettings.get(ctx.message.guild.id).modroles
         if role.id not in roleIDs:
-            await sql.execute("INSERT INTO modroles VALUES(?, ?)", str(ctx.message.guild.id), str(role.id))
+            await guildsettings.add_modrole(ctx.message.guild.id, role.id)
             em = discord.Embed(title=f"Succesfully added \"{role.name}\" to mod roles list",
                                colour=discord.Colour.dark_green())
         else:
@@ -95,9 +94,9 @@ class AdminCommands(commands.Cog):
         """
         Remove a moderator role from the defined list.
         """
-        roleIDs = [int(roleID[0]) for roleID in await sql.fetch("SELECT roleid FROM modroles WHERE serverid=?", str(ctx.message.guild.id))]
+        roleIDs = guildsettings.get(ctx.message.guild.id).modroles
         if role.id in roleIDs:
-            await sql.execute("DELETE FROM modroles WHERE serverid=? AND roleid=?", str(ctx.message.guild.id), str(role.id))
+            await guildsettings.remove_modrole(ctx.message.guild.id, role.id)
             em = discord.Embed(title=f"Succesfully removed \"{role.name}\" from mod roles list.",
                                colour=discord.Colour.dark_green())
         else:
@@ -112,7 +111,7 @@ class AdminCommands(commands.Cog):
         """
         List the available prefixes for this server.
         """
-        prefixes = [result[0] for result in await sql.fetch("SELECT prefix FROM prefixes WHERE serverid=?", str(ctx.message.guild.id))]
+        prefixes = guildsettings.get(ctx.message.guild.id).prefixes
         if prefixes:
             em = discord.Embed(title=f"Defined prefixes for {ctx.message.guild.name}",
                                description=f"`{'`, `'.join(prefixes)}`",
@@ -130,9 +129,9 @@ class AdminCommands(commands.Cog):
         """
         Adds a prefix to the list of defined ones.
         """
-        prefixes = [result[0] for result in await sql.fetch("SELECT prefix FROM prefixes WHERE serverid=?", str(ctx.message.guild.id))]
+        prefixes = guildsettings.get(ctx.message.guild.id).prefixes
         if prefix not in prefixes:
-            await sql.execute("INSERT INTO prefixes VALUES(?, ?)", str(ctx.message.guild.id), prefix)
+            await guildsettings.add_prefix(ctx.message.guild.id, prefix)
             em = discord.Embed(title=f"Added `{prefix}` to prefixes",
                                description=f"To see the list of all defined prefixes, use `{prefix}prefixes`",
                                colour=discord.Colour.dark_green())
@@ -149,9 +148,9 @@ class AdminCommands(commands.Cog):
         """
         Removes a prefix from the defined list.
         """
-        prefixes = [result[0] for result in await sql.fetch("SELECT prefix FROM prefixes WHERE serverid=?", str(ctx.message.guild.id))]
+        prefixes = guildsettings.get(ctx.message.guild.id).prefixes
         if prefix in prefixes:
-            await sql.execute("DELETE FROM prefixes WHERE serverid=? AND prefix=?", str(ctx.message.guild.id), prefix)
+            await guildsettings.remove_prefix(ctx.message.guild.id, prefix)
             em = discord.Embed(title=f"Removed `{prefix}` from prefixes",
                                description=f"To see the list of all defined prefixes, use {self.bot.user.mention} prefixes",
                                colour=discord.Colour.dark_green())
@@ -176,8 +175,9 @@ class AdminCommands(commands.Cog):
                                 colour=discord.Colour.red())
             await ctx.send(embed=em, ephemeral=True)
         elif view.value:
-            await sql.deleteserver(ctx.message.guild.id)
-            await sql.initserver(ctx.message.guild.id)
+            # Mutes and bans aren't settings, and would otherwise be lifted without the members being told
+            await guildsettings.deleteserver(ctx.message.guild.id, punishments=False)
+            await guildsettings.initserver(ctx.message.guild.id)
             em = discord.Embed(title="Reset all data for this server",
                             colour=discord.Colour.dark_green())
             await ctx.send(embed=em)
@@ -279,7 +279,7 @@ class AdminCommands(commands.Cog):
         When executing commands, text after the symbol message will be ignored.
         Use without a comment after the command to set no comment.
         """
-        await sql.execute("UPDATE servers SET comment=? WHERE serverid=?", comment, str(ctx.message.guild.id))
+        await guildsettings.set_comment(ctx.message.guild.id, comment)
         em = discord.Embed(colour=discord.Colour.dark_green())
         if comment:
             em.title = f"Successfully changed comment symbol to `{comment}`."
@@ -295,19 +295,36 @@ class AdminCommands(commands.Cog):
         Use without additional arguments to disable the functionality.
         """
         if channel is not None:
-            await sql.execute("UPDATE servers SET joinleavechannel=? WHERE serverid=?", str(channel.id), str(ctx.message.guild.id))
+            await guildsettings.set_joinleavechannel(ctx.message.guild.id, channel.id)
             em = discord.Embed(title=f"Successfully set join/leave events channel to {channel.mention}",
                                colour=discord.Colour.dark_green())
         else:
-            await sql.execute("UPDATE servers SET joinleavechannel=? WHERE serverid=?", None, str(ctx.message.guild.id))
+            await guildsettings.set_joinleavechannel(ctx.message.guild.id, None)
             em = discord.Embed(title="Successfully disabled join/leave events",
                                colour=discord.Colour.dark_green())
         await ctx.send(embed=em)
 
+    @commands.hybrid_command(name="setfffchannel")
+    @customchecks.is_mod()
+    async def set_fff_channel(self, ctx: commands.Context, channel: discord.TextChannel = None):
+        """
+        Set the channel new Friday Facts are posted in.
+        Use without additional arguments to disable the functionality.
+        """
+        if channel is not None:
+            await guildsettings.set_fffchannel(ctx.message.guild.id, channel.id)
+            em = discord.Embed(title=f"Successfully set Friday Facts channel to {channel.mention}",
+                               colour=discord.Colour.dark_green())
+        else:
+            await guildsettings.set_fffchannel(ctx.message.guild.id, None)
+            em = discord.Embed(title="Successfully disabled Friday Facts posts",
+                               colour=discord.Colour.dark_green())
+        await ctx.send(embed=em)
+
     @commands.hybrid_command(name="setmuterole")
     @customchecks.is_mod()
     async def set_mute_role(self, ctx: commands.Context, *, role: discord.Role):
-        await sql.execute("UPDATE servers SET muteroleid=? WHERE serverid=?", str(role.id), str(ctx.message.guild.id))
+        await guildsettings.set_muterole(ctx.message.guild.id, role.id)
         em = discord.Embed(title="Succesfully changed mute role",
                            description=f"New role is `{role.name}`",
                            colour=discord.Colour.dark_green())
@@ -317,18 +334,17 @@ class AdminCommands(commands.Cog):
     @customchecks.is_mod()
     async def mute(self, ctx: commands.Context, user: discord.User, *, reason: str = None):
         guild = ctx.message.guild
-        roleRow = await sql.fetch("SELECT muteroleid FROM servers WHERE serverid=?",
-                                  str(guild.id))
-        if roleRow[0][0] is not None:
-            role = guild.get_role(int(roleRow[0][0]))
+        muteRoleID = guildsettings.get(guild.id).muteroleid
+        if muteRoleID is not None:
+            role = guild.get_role(muteRoleID)
         else:
             role = None
         prevmute = await sql.fetch("SELECT until FROM mutes WHERE serverid=? AND userid=?",
-                                   str(guild.id), str(user.id))
+                                   guild.id, user.id)
         if len(prevmute) == 0:
             if role is not None:
                 await sql.execute("INSERT INTO mutes VALUES (?, ?, ?)",
-                                  str(guild.id), str(user.id), None)
+                                  guild.id, user.id, None)
 
                 mutedName = user.name
                 if (member := await lazily_fetch_member(guild, user.id)) is not None:
@@ -373,14 +389,13 @@ class AdminCommands(commands.Cog):
         delta = timeparse(time)
         until = pytz.utc.localize(datetime.datetime.utcnow() + datetime.timedelta(seconds=delta)).replace(microsecond=0)
         prevmute = await sql.fetch("SELECT until FROM mutes WHERE serverid=? AND userid=?",
-                                   str(guild.id), str(user.id))
+                                   guild.id, user.id)
         if len(prevmute) == 0:
             await sql.execute("INSERT INTO mutes VALUES (?, ?, ?)",
-                              str(guild.id), str(user.id), until)
-            roleRow = await sql.fetch("SELECT muteroleid FROM servers WHERE serverid=?",
-                                      str(guild.id))
-            if roleRow[0][0] is not None:
-                role = guild.get_role(int(roleRow[0][0]))
+                              guild.id, user.id, until)
+            muteRoleID = guildsettings.get(guild.id).muteroleid
+            if muteRoleID is not None:
+                role = guild.get_role(muteRoleID)
             else:
                 role = None
             if role is not None:
@@ -395,7 +410,7 @@ class AdminCommands(commands.Cog):
                     await punishmentshelper.notify(member, ctx.message.author,
                                                    title="Temporary mute", reason=reason,
                                                    duration=delta, until=until)
-                    asyncio.ensure_future(punishmentshelper.ensure_unmute(guild, member.id, delta, role))
+                punishmentshelper.scheduler.schedule(punishmentshelper.MUTE, guild.id, user.id, until)
                 em = discord.Embed(title=f"Succesfully muted {mutedName}",
                                    description=f"Will be muted until {until.isoformat()}.",
                                    colour=discord.Colour.dark_green())
@@ -427,14 +442,14 @@ class AdminCommands(commands.Cog):
         """
         guild = ctx.message.guild
         prevmute = await sql.fetch("SELECT until FROM mutes WHERE serverid=? AND userid=?",
-                                   str(guild.id), str(user.id))
+                                   guild.id, user.id)
         if len(prevmute) > 0:
             await sql.execute("DELETE FROM mutes WHERE serverid=? AND userid=?",
-                              str(guild.id), str(user.id))
-            roleRow = await sql.fetch("SELECT muteroleid FROM servers WHERE serverid=?",
-                                      str(guild.id))
-            if roleRow[0][0] is not None:
-                role = guild.get_role(int(roleRow[0][0]))
+                              guild.id, user.id)
+            punishmentshelper.scheduler.cancel(punishmentshelper.MUTE, guild.id, user.id)
+            muteRoleID = guildsettings.get(guild.id).muteroleid
+            if muteRoleID is not None:
+                role = guild.get_role(muteRoleID)
             else:
                 role = None
             mutedName = user.name
@@ -479,19 +494,19 @@ class AdminCommands(commands.Cog):
         delta = timeparse(time)
         until = pytz.utc.localize(datetime.datetime.utcnow() + datetime.timedelta(seconds=delta)).replace(microsecond=0)
         prevban = await sql.fetch("SELECT until FROM bans WHERE serverid=? AND userid=?",
-                                  str(guild.id), str(member.id))
+                                  guild.id, member.id)
         if len(prevban) == 0:
             await punishmentshelper.notify(member, ctx.message.author,
                                            title="Temporary ban", reason=reason,
                                            duration=delta, until=until)
             await member.ban(reason=reason, delete_message_days=0)
             await sql.execute("INSERT INTO bans VALUES (?, ?, ?)",
-                              str(guild.id), str(member.id), until)
+                              guild.id, member.id, until)
             em = discord.Embed(title=f"Succesfully banned {member.display_name}",
                                description=f"Will be banned until {until.isoformat()}.",
                                colour=discord.Colour.dark_green())
+            punishmentshelper.scheduler.schedule(punishmentshelper.BAN, guild.id, member.id, until)
             await ctx.send(embed=em)
-            asyncio.ensure_future(punishmentshelper.ensure_unban(guild, member, delta))
         else:
             until = datetime.datetime.strptime(prevban[0][0], "%Y-%m-%d %H:%M:%S%z")
             em = discord.Embed(title="Error",
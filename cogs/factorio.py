@@ -1,15 +1,47 @@
-import aiohttp
+import asyncio
 import bs4
+import collections
+import concurrent.futures
+import datetime
 import feedparser
+import json
+import logging
+import multiprocessing
 import re
 import tomd
+from ago import human
 
 import discord
-from discord.ext import commands
+from discord import app_commands
+from discord.ext import commands, tasks
 
-from typing import Tuple
+from typing import Awaitable, Callable, Dict, List, Tuple, Union
 
-WIKI_API_URL = "https://wiki.factorio.com/api.php"
+from utils import guildsettings, sql, web
+from utils.modportal import ModInfo, ModPortal
+from utils.wikiindex import WikiIndex
+from utils.singleflight import singleflight
+
+WIKI_BASE_URL = "wiki.factorio.com"
+WIKI_API_URL = f"https://{WIKI_BASE_URL}/api.php"
+WIKI_NAMESPACES = [0, 3000]  # Main and Tutorial
+WIKI_INDEX_REFRESH_INTERVAL = 6  # Hours
+MAX_INLINE_LOOKUPS = 10
+# How long a lookup can take before a "Searching..." message is sent, in seconds
+PLACEHOLDER_DELAY = 0.5
+MAX_INTRO_CACHE_SIZE = 4096  # Pages
+# How long responses are cached before being revalidated, in seconds
+WIKI_TTL = 60 * 60
+MOD_SEARCH_TTL = 10 * 60
+MOD_INDEX_REFRESH_INTERVAL = 6  # Hours
+# Shorter than the poll interval, so that every poll revalidates the feed with a conditional request
+RSS_TTL = 60
+RSS_POLL_INTERVAL = 5 * 60
+FFF_RSS_URL = "https://www.factorio.com/blog/rss"
+MAX_FFF_SEARCH_RESULTS = 5
+# Discord's limits for the embeds of a single message
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARS_PER_MESSAGE = 6000
 
 headerEx = re.compile(r"((^<br/>$)|(This (article|page)))")
 referEx = re.compile(r".*? may refer to\:")
@@ -20,132 +52,496 @@ fffEx = re.compile(r"Friday Facts #(\d*)")
 propEx = re.compile(r"^(\w+ :: [^:]+)(: (.+))?$")
 markdownEx = re.compile(r"([~*_`])")
 
+logger = logging.getLogger('root')
+
+# English page titles of the wiki
+wikiIndex = WikiIndex(WIKI_API_URL, WIKI_NAMESPACES, exclude=langEx)
+
+# (base URL, revision ID) -> wiki_intro result
+introCache: "collections.OrderedDict[Tuple[str, int], Tuple[str, bool]]" = collections.OrderedDict()
+
+modPortal = ModPortal()
+
+# Only the result count and the result cards are needed from mod portal search pages
+modSearchStrainer = bs4.SoupStrainer("div", class_=["grey", "flex-column"])
+PARSER_WORKERS = 2
+parserPool: Union[concurrent.futures.ProcessPoolExecutor, None] = None
+
+
+def get_parser_pool() -> concurrent.futures.ProcessPoolExecutor:
+    """
+    Returns the process pool HTML is parsed in, so that large pages don't block the event loop
+    """
+    global parserPool
+    if parserPool is None:
+        # The bot already runs threads (e.g. the database connections) by now, which makes forking it unsafe
+        parserPool = concurrent.futures.ProcessPoolExecutor(max_workers=PARSER_WORKERS,
+                                                            mp_context=multiprocessing.get_context("forkserver"))
+    return parserPool
 
-async def get_soup(url: str) -> Tuple[int, bs4.BeautifulSoup]:
+
+async def run_parser(parser: Callable, *args):
     """
-    Returns a list with the response code (as int) and a BeautifulSoup object of the URL
+    Runs a parser function in the parser pool, and returns its (picklable) result
     """
-    async with aiohttp.ClientSession() as client:
-        async with client.get(url) as resp:
-            status = resp.status
-            r = await resp.text()
-    return (status, bs4.BeautifulSoup(r, "html.parser"))
+    return await asyncio.get_running_loop().run_in_executor(get_parser_pool(), parser, *args)
 
 
-def mod_embed(result: bs4.BeautifulSoup) -> discord.Embed:
+def parse_mod(result: bs4.Tag) -> dict:
     """
-    Returns a discord.Embed object derived from a mod page BeautifulSoup
+    Extracts the details of a mod from its card in the mod portal
     """
-    taglist = []
-    fields = []
     headerAndSummaryDiv = result.find("div", class_="w100p")
     infoCard = result.find("div", class_="mod-card-info")
     footer = result.find("div", class_="panel-inset")
 
     title = headerAndSummaryDiv.find("h2", class_="mb0").find("a")
-    summary = headerAndSummaryDiv.find("p", class_="pre-line").string
-    em = discord.Embed(title=title.string,
-                       url=f"https://mods.factorio.com{title['href'].replace(' ', '%20')}",
-                       description=markdownEx.sub(r"\\\1", summary),
-                       colour=discord.Colour.dark_green())
     thumbnail = result.find("div", class_="mod-thumbnail").find("img")
-    if thumbnail is not None:
-        em.set_thumbnail(url=thumbnail["src"])
     owner = headerAndSummaryDiv.find("div").find("a", class_="orange")
-    fields.append({"name": "Owner", "value": f"[{owner.string}](https://mods.factorio.com{owner['href']})"})
-    for tag in footer.find_all("a", class_="slot-button-inline"):
-        taglist.append(f"[{tag.string.strip()}](https://mods.factorio.com{tag['href']})")
-    gameVersions = infoCard.find("div", title="Available for these Factorio versions").contents[2].strip()
-    downloads = infoCard.find("div", title="Downloads, updated daily").contents[2].strip()
     createdAtDiv = infoCard.find("div", title="Last updated")
-    createdAt = createdAtDiv.find("span").contents[0].strip()
-    fields.extend([{"name": "Category", "value": "None" if len(taglist) == 0 else ", ".join(taglist)},
-                   {"name": "Game Version(s)", "value": gameVersions},
-                   {"name": "Downloads", "value": downloads},
-                   {"name": "Updated", "value": createdAt}])
+    return {
+        "title": str(title.string),
+        "href": title["href"],
+        "summary": str(headerAndSummaryDiv.find("p", class_="pre-line").string),
+        "thumbnail": thumbnail["src"] if thumbnail is not None else None,
+        "owner": str(owner.string),
+        "ownerHref": owner["href"],
+        "tags": [(tag.string.strip(), tag["href"]) for tag in footer.find_all("a", class_="slot-button-inline")],
+        "gameVersions": infoCard.find("div", title="Available for these Factorio versions").contents[2].strip(),
+        "downloads": infoCard.find("div", title="Downloads, updated daily").contents[2].strip(),
+        "updated": createdAtDiv.find("span").contents[0].strip()
+    }
+
+
+def parse_mod_search(html: str, modname: str) -> dict:
+    """
+    Extracts the results from a mod portal search page.
+    Returns {"count": 0} if there are none, {"mod": ...} for a single (or exactly named) mod
+    and {"results": [...]} with up to 5 summaries otherwise.
+    """
+    soup = bs4.BeautifulSoup(html, "html.parser", parse_only=modSearchStrainer)
+    if " 0 " in soup.find("div", class_="grey").string:
+        return {"count": 0}
+    cards = soup.find_all("div", class_="flex-column")
+    if len(cards) == 1:
+        return {"mod": parse_mod(cards[0])}
+    results = []
+    for result in cards[:5]:
+        title = result.find("h2", class_="mb0").find("a")
+        if title.string.title() == modname.title():
+            return {"mod": parse_mod(result)}
+        results.append({"title": str(title.string),
+                        "href": title["href"],
+                        "author": str(result.find("a", class_="orange").string),
+                        "summary": str(result.find("p", class_="pre-line").string)})
+    return {"results": results}
+
+
+def mod_embed(mod: dict) -> discord.Embed:
+    """
+    Returns a discord.Embed object derived from mod details returned by parse_mod
+    """
+    em = discord.Embed(title=mod["title"],
+                       url=modPortal.url(mod['href'].replace(' ', '%20')),
+                       description=markdownEx.sub(r"\\\1", mod["summary"]),
+                       colour=discord.Colour.dark_green())
+    if mod["thumbnail"] is not None:
+        em.set_thumbnail(url=mod["thumbnail"])
+    taglist = [f"[{name}]({modPortal.url(href)})" for name, href in mod["tags"]]
+    fields = [{"name": "Owner", "value": f"[{mod['owner']}]({modPortal.url(mod['ownerHref'])})"},
+              {"name": "Category", "value": "None" if len(taglist) == 0 else ", ".join(taglist)},
+              {"name": "Game Version(s)", "value": mod["gameVersions"]},
+              {"name": "Downloads", "value": mod["downloads"]},
+              {"name": "Updated", "value": mod["updated"]}]
     for field in fields:
         em.add_field(**field, inline=True)
     return em
 
 
+def api_mod(mod: dict) -> dict:
+    """
+    Returns the details of a mod from the mod portal API in the format returned by parse_mod
+    """
+    releases = mod.get("releases") or []
+    category = mod.get("category")
+    return {
+        "title": mod["title"],
+        "href": f"/mod/{mod['name']}",
+        "summary": mod.get("summary", ""),
+        "thumbnail": modPortal.thumbnail_url(mod.get("thumbnail")),
+        "owner": mod["owner"],
+        "ownerHref": f"/user/{mod['owner']}",
+        "tags": [(category.title(), f"/?category={category}")] if category and category != "no-category" else [],
+        "gameVersions": ", ".join(sorted({release["info_json"]["factorio_version"] for release in releases})) or "None",
+        "downloads": f"{mod.get('downloads_count', 0):,}",
+        "updated": human(datetime.datetime.fromisoformat(releases[-1]["released_at"].replace("Z", "+00:00")), precision=1)
+                   if releases else "Never"
+    }
+
+
+def parse_fff(html: str) -> dict:
+    """
+    Extracts the title and the (Markdown formatted) sections of an FFF blog post
+    """
+    soup = bs4.BeautifulSoup(html, "html.parser")
+    titleList = soup.find_all("h2")
+    fff = {"title": titleList[0].string.strip(), "sections": []}
+    titleList = titleList[1:]
+    if len(titleList) == 0:
+        titleList = soup.find_all("h4")
+    if len(titleList) == 0:
+        titleList = soup.find_all("h3")
+    for title in titleList:
+        # Check for smaller font tag and append it to the title
+        result = fontEx.search(str(title))
+        if len([group for group in result.groups() if group is not None]) == 1:
+            name = result.group(1)
+        else:
+            name = result.group(1) + result.group(3)
+        content = str(title.next_sibling.next_sibling)
+        if "<p>" not in content:
+            continue
+        if "<ol>" in content:
+            itemCount = 1
+            while "<li>" in content:
+                content = content.replace("<li>", f"{itemCount}. ", 1)
+                itemCount += 1
+        if "<ul>" in content:
+            content = content.replace("<li>", "- ")
+        for item in ["<ol>", "</ol>", "<ul>", "</ul>", "</li>", "<br/>"]:
+            content = content.replace(item, "")
+        # Escape Discord formatting characters
+        for item in ["*", "_"]:
+            content = content.replace(item, "\\" + item)
+        content = content.replace("\n\n", "\n")
+        fff["sections"].append((name.replace("amp;", ""), tomd.convert(content).strip()))
+    return fff
+
+
+async def get_archived_fff(number: int) -> Union[dict, None]:
+    """
+    Returns the FFF with the given number from the archive, or None if it hasn't been archived
+    """
+    rows = await sql.fetch("SELECT title, sections FROM fffs WHERE number=?", number)
+    if len(rows) == 0:
+        return None
+    return {"title": rows[0][0], "sections": json.loads(rows[0][1])}
+
+
+async def archive_fff(number: int, fff: dict):
+    """
+    Stores a parsed FFF in the archive and its search index. Posts don't change after they're published,
+    so an archived FFF is never downloaded again.
+    """
+    body = "\n".join(f"{name}\n{value}" for name, value in fff["sections"])
+    await sql.executemany_queries(("INSERT OR REPLACE INTO fffs (number, title, sections) VALUES (?, ?, ?)",
+                                   number, fff["title"], json.dumps(fff["sections"])),
+                                  ("DELETE FROM fff_search WHERE rowid=?", number),
+                                  ("INSERT INTO fff_search (rowid, title, body) VALUES (?, ?, ?)",
+                                   number, fff["title"], body),
+                                  wait=False)
+
+
+@singleflight(lambda number: int(number))
+async def get_fff(number: int) -> Tuple[int, Union[dict, None]]:
+    """
+    Returns the FFF with the given number from the archive, downloading and archiving it if needed.
+    Returns the response code as well, and None instead of the FFF if it couldn't be downloaded.
+    """
+    fff = await get_archived_fff(number)
+    if fff is not None:
+        return 200, fff
+    status, html = await web.fetch(f"https://factorio.com/blog/post/fff-{number}")
+    if status == 200:
+        fff = await run_parser(parse_fff, html)
+        await archive_fff(number, fff)
+    return status, fff
+
+
+def fff_embed(number: int, fff: dict) -> discord.Embed:
+    """
+    Returns a discord.Embed object derived from an FFF returned by get_fff
+    """
+    em = discord.Embed(title=fff["title"],
+                       url=f"https://factorio.com/blog/post/fff-{number}",
+                       colour=discord.Colour.dark_green())
+    for name, value in fff["sections"]:
+        em.add_field(name=name, value=value)
+    return em
+
+
 async def embed_fff(number: int) -> discord.Embed:
     """
     Returns a discord.Embed object derived from an fff number
     """
-    link = f"https://factorio.com/blog/post/fff-{number}"
-    response = await get_soup(link)
-    if response[0] == 200:
-        soup = response[1]
-        titleList = soup.find_all("h2")
-        em = discord.Embed(title=titleList[0].string.strip(),
-                           url=link,
-                           colour=discord.Colour.dark_green())
-        titleList = titleList[1:]
-        if len(titleList) == 0:
-            titleList = soup.find_all("h4")
-        if len(titleList) == 0:
-            titleList = soup.find_all("h3")
-        for title in titleList:
-            # Check for smaller font tag and append it to the title
-            result = fontEx.search(str(title))
-            if len([group for group in result.groups() if group is not None]) == 1:
-                name = result.group(1)
-            else:
-                name = result.group(1) + result.group(3)
-            content = str(title.next_sibling.next_sibling)
-            if "<p>" not in content:
-                continue
-            if "<ol>" in content:
-                itemCount = 1
-                while "<li>" in content:
-                    content = content.replace("<li>", f"{itemCount}. ", 1)
-                    itemCount += 1
-            if "<ul>" in content:
-                content = content.replace("<li>", "- ")
-            for item in ["<ol>", "</ol>", "<ul>", "</ul>", "</li>", "<br/>"]:
-                content = content.replace(item, "")
-            # Escape Discord formatting characters
-            for item in ["*", "_"]:
-                content = content.replace(item, "\\" + item)
-            content = content.replace("\n\n", "\n")
-            em.add_field(name=name.replace("amp;", ""),
-                         value=tomd.convert(content).strip())
-    else:
-        em = discord.Embed(title="Error",
-                           description=f"Couldn't find FFF #{number}.",
-                           colour=discord.Colour.red())
-    return em
+    _, fff = await get_fff(number)
+    if fff is not None:
+        return fff_embed(number, fff)
+    return discord.Embed(title="Error",
+                         description=f"Couldn't find FFF #{number}.",
+                         colour=discord.Colour.red())
 
-async def get_wiki_page_safe(client, api_url, title):
-    async with client.get(api_url, params={
-        "action": "parse",
-        "format": "json",
-        "action": "query",
-        "titles": title,
-        "prop": "revisions",
-        "rvprop": "content"
-    }) as page_info:
-        pagejson = await page_info.json()
-        page = pagejson["query"]["pages"]
-        if "revisions" in list(page.values())[0]:
-            revisions = list(page.values())[0]["revisions"][0]
-            title = list(page.values())[0]["title"]
-            content = list(revisions.values())[2]
-            return content
-        return ""
-
-async def search_wiki_page(client, api_url, title):
-    async with client.get(api_url, params={
+
+async def search_fffs(query: str) -> List[Tuple[int, str, str]]:
+    """
+    Returns the number, title and a snippet of the archived FFFs best matching the query
+    """
+    # Quote every word, so that FTS5 query syntax in the input can't cause errors
+    match = " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+    if not match:
+        return []
+    return await sql.fetch("SELECT rowid, title, snippet(fff_search, 1, '**', '**', '...', 16) FROM fff_search "
+                           "WHERE fff_search MATCH ? ORDER BY rank LIMIT ?", match, MAX_FFF_SEARCH_RESULTS)
+
+
+async def search_wiki_page(api_url, title):
+    status, pagejson = await web.fetch_json(api_url, {
         "action": "query",
         "format": "json",
         "list": "search",
         "srsearch": title,
         "srnamespace": "0|3000"
-    }) as page_info:
-        pagejson = await page_info.json()
-        totalhits = pagejson["query"]["searchinfo"]["totalhits"]
-        results = pagejson["query"]["search"]
-        return totalhits, results
+    }, WIKI_TTL)
+    if pagejson is None:
+        return status, 0, []
+    totalhits = pagejson["query"]["searchinfo"]["totalhits"]
+    results = pagejson["query"]["search"]
+    return status, totalhits, results
+
+@singleflight(lambda api_url, titles: (api_url, tuple(titles)))
+async def get_wiki_pages(api_url, titles: List[str]) -> Tuple[int, Dict[str, Tuple[str, int, str]]]:
+    """
+    Looks up all of the titles in one request, following normalization and redirects.
+    Returns the response code, and the (title, revision ID, intro section wikitext) of the page
+    for every title that names an existing page.
+    """
+    status, pagejson = await web.fetch_json(api_url, {
+        "action": "query",
+        "format": "json",
+        "titles": "|".join(titles),
+        "redirects": 1,
+        "prop": "revisions",
+        "rvprop": "ids|content",
+        # Only the intro is shown, so there's no need to download the rest of the page
+        "rvsection": 0
+    }, WIKI_TTL)
+    query = pagejson.get("query", {}) if pagejson is not None else {}
+    aliases = {alias["from"]: alias["to"] for alias in query.get("normalized", []) + query.get("redirects", [])}
+    pages = {page["title"]: page for page in query.get("pages", {}).values() if "revisions" in page}
+    found = {}
+    for title in titles:
+        resolved = title
+        seen = set()
+        while resolved in aliases and resolved not in seen:
+            seen.add(resolved)
+            resolved = aliases[resolved]
+        if resolved in pages:
+            revision = pages[resolved]["revisions"][0]
+            found[title] = (resolved, revision["revid"], revision["*"])
+    return status, found
+
+
+def wiki_intro(baseURL: str, revid: int, content: str) -> Tuple[str, bool]:
+    """
+    Returns the Markdown formatted intro paragraph of a page's wikitext, and whether the page has an infobox.
+    Results are cached per revision.
+    """
+    key = (baseURL, revid)
+    if key in introCache:
+        introCache.move_to_end(key)
+        return introCache[key]
+    paragraphs = str.split(content, "\n")
+    try: intropar = [par for par in paragraphs if par != '' and par[0] != "{" and par[0] != "<"][0]
+    except IndexError: intropar = paragraphs[1] if len(paragraphs) > 1 else ""
+    formatted = linkEx.sub(
+                    lambda m: f"[{m[2] or m[1]}](https://{baseURL}/{m[1].replace(' ', '_')})",
+                    intropar)
+    formatted = formatted.replace("'", "")
+    introCache[key] = (formatted, "Infobox" in paragraphs[0])
+    if len(introCache) > MAX_INTRO_CACHE_SIZE:
+        introCache.popitem(last=False)
+    return introCache[key]
+
+
+def wiki_page_embed(baseURL: str, title: str, revid: int, content: str) -> discord.Embed:
+    """
+    Returns a discord.Embed object with the intro paragraph of a wiki page
+    """
+    url = f"https://{baseURL}/" + title.replace(" ", "_")
+    intro, hasInfobox = wiki_intro(baseURL, revid, content)
+    em = discord.Embed(title=title,
+                    url=url,
+                    description=intro,
+                    color=discord.Colour.green())
+    if hasInfobox:
+        image_url = f"https://{baseURL}/images/{title.replace(' ', '_')}.png"
+        em.set_thumbnail(url=image_url)
+    return em
+
+
+async def get_wiki_page_embed(title: str) -> Tuple[int, Union[discord.Embed, None]]:
+    """
+    Returns the response code, and an embed with the intro of the wiki page with the given title
+    (None if there's no such page)
+    """
+    status, pages = await get_wiki_pages(WIKI_API_URL, [title])
+    if title not in pages:
+        return status, None
+    return status, wiki_page_embed(WIKI_BASE_URL, *pages[title])
+
+
+def wiki_unreachable_embed() -> discord.Embed:
+    """
+    Returns the error embed shown when the wiki is down
+    """
+    return discord.Embed(title="Error",
+                         description=f"Couldn't reach {WIKI_BASE_URL}.",
+                         colour=discord.Colour.red())
+
+
+@singleflight(lambda searchterm: searchterm.lower())
+async def wiki_search_embed(searchterm: str) -> Tuple[discord.Embed, bool]:
+    """
+    Searches the wiki for the term.
+    Returns an embed with the result(s), and whether anything was found.
+    """
+    title = wikiIndex.resolve(searchterm)
+    if title is not None:
+        status, em = await get_wiki_page_embed(title)
+        if em is not None:
+            return em, True
+        if status != 200:
+            return wiki_unreachable_embed(), False
+
+    status, totalhits, results = await search_wiki_page(WIKI_API_URL, searchterm)
+    if status != 200:
+        return wiki_unreachable_embed(), False
+    if totalhits == 0:
+        em = discord.Embed(title="Error",
+            description=f"Could not find \"{searchterm.title()}\" in wiki.",
+            colour=discord.Colour.red())
+        return em, False
+
+    if results[0]["title"].lower() == searchterm.lower():
+        title = results[0]["title"]
+        _, em = await get_wiki_page_embed(title)
+        if em is not None:
+            return em, True
+
+    engResults = []
+    for result in results:
+        if langEx.search(result["title"]) is None:
+            engResults.append(result)
+    if engResults != []:
+        if len(engResults) == 1:
+            title = engResults[0]["title"]
+            _, em = await get_wiki_page_embed(title)
+            if em is not None:
+                return em, True
+        em = discord.Embed(title="Factorio Wiki",
+                        url=f"https://{WIKI_BASE_URL}/index.php?search={searchterm}".replace(' ', '_'),
+                        color=discord.Colour.gold())
+        for result in engResults:
+            url = f"https://{WIKI_BASE_URL}/{result['title'].replace(' ', '_')}"
+            em.add_field(name = result["title"], value = f"[Read More]({url})")
+        return em, True
+
+    em = discord.Embed(title="Error",
+                       description=f"Could not find English results for \"{searchterm.title()}\" in wiki.",
+                       color=discord.Colour.red())
+    return em, False
+
+
+async def wiki_embeds(searchterms: List[str]) -> List[discord.Embed]:
+    """
+    Returns embeds for every search term that was found in the wiki, in order.
+    Exact titles are resolved together in one request; only the rest are searched for.
+    """
+    if not searchterms:
+        return []
+    if wikiIndex.loaded:
+        # Only terms that are known titles need to be looked up, in their proper case
+        titles = {term: wikiIndex.resolve(term) for term in searchterms}
+        titles = {term: title for term, title in titles.items() if title is not None}
+    else:
+        # "|" separates titles in the API, and can't be part of one anyway
+        titles = {term: term for term in searchterms if "|" not in term}
+    pages = {}
+    if titles:
+        try:
+            status, pages = await get_wiki_pages(WIKI_API_URL, list(dict.fromkeys(titles.values())))
+        except Exception:
+            # The terms are still searched for one by one
+            logger.exception("Couldn't look up wiki pages")
+        else:
+            # Searching for every term wouldn't get through either
+            if status != 200:
+                return []
+
+    async def embed_term(searchterm: str) -> Union[discord.Embed, None]:
+        if titles.get(searchterm) in pages:
+            return wiki_page_embed(WIKI_BASE_URL, *pages[titles[searchterm]])
+        em, found = await wiki_search_embed(searchterm)
+        return em if found else None
+
+    embeds = []
+    urls = set()
+    # Different terms can lead to the same page
+    results = await asyncio.gather(*[embed_term(searchterm) for searchterm in searchterms], return_exceptions=True)
+    for searchterm, em in zip(searchterms, results):
+        # A failed lookup shouldn't lose the results of the others
+        if isinstance(em, BaseException):
+            logger.error(f"Couldn't look up \"{searchterm}\" in the wiki", exc_info=em)
+        elif em is not None and em.url not in urls:
+            urls.add(em.url)
+            embeds.append(em)
+    return embeds
+
+
+def parse_latest_fff(rss: str) -> Union[int, None]:
+    """
+    Returns the number of the latest FFF in the factorio.com blog RSS feed, or None if there's none
+    """
+    for entry in feedparser.parse(rss).entries:
+        match = fffEx.search(entry.title)
+        if "friday facts" in entry.title.lower() and match is not None and match.group(1):
+            return int(match.group(1))
+    return None
+
+
+@singleflight(lambda: None)
+async def get_latest_fff() -> Union[int, None]:
+    """
+    Returns the number of the latest FFF from the factorio.com blog RSS feed, or None if it couldn't be reached
+    """
+    status, r = await web.fetch(FFF_RSS_URL, ttl=RSS_TTL)
+    if status != 200:
+        return None
+    return await run_parser(parse_latest_fff, r)
+
+
+async def send_lookup(ctx: commands.Context, lookup: Awaitable[Tuple[discord.Embed, bool]], placeholder: discord.Embed):
+    """
+    Sends the embed a lookup results in.
+    The placeholder is only sent (and then edited) if the lookup takes longer than PLACEHOLDER_DELAY,
+    so fast lookups cost a single message. Results that weren't found aren't sent without a prefix.
+    """
+    task = asyncio.ensure_future(lookup)
+    bufferMsg = None
+    done, _ = await asyncio.wait({task}, timeout=PLACEHOLDER_DELAY)
+    if not done:
+        bufferMsg = await ctx.send(embed=placeholder)
+        async with ctx.channel.typing():
+            await asyncio.wait({task})
+    em, found = task.result()
+    if not found and ctx.prefix is None:
+        if bufferMsg is not None:
+            await bufferMsg.delete()
+    elif bufferMsg is not None:
+        await bufferMsg.edit(embed=em)
+    else:
+        await ctx.send(embed=em)
+
 
 async def process_wiki(ctx: commands.Context, searchterm: str):
     """
@@ -158,73 +554,254 @@ async def process_wiki(ctx: commands.Context, searchterm: str):
                            colour=discord.Colour.red())
         await ctx.send(embed=em)
         return
-    baseURL = "wiki.factorio.com"
 
-    #Buffer message
-    em = discord.Embed(title=f"Searching for \"{searchterm.title()}\" in {baseURL}...",
+    em = discord.Embed(title=f"Searching for \"{searchterm.title()}\" in {WIKI_BASE_URL}...",
                        description="This shouldn't take long.",
                        colour=discord.Colour.gold())
-    bufferMsg = await ctx.send(embed=em)
-    async with ctx.channel.typing():
-        async with aiohttp.ClientSession() as client:
-            totalhits, results = await search_wiki_page(client, WIKI_API_URL, searchterm)
-            if totalhits == 0:
-                em = discord.Embed(title="Error",
-                    description=f"Could not find \"{searchterm.title()}\" in wiki.",
-                    colour=discord.Colour.red())
-                await bufferMsg.edit(embed=em) if ctx.prefix is not None else await bufferMsg.delete()
-
-            elif results[0]["title"].lower() == searchterm.lower():
-                await wiki_page_embed(baseURL, bufferMsg, client, results[0])
-            else: 
-                engResults = []
-                for result in results:
-                    if langEx.search(result["title"]) is None:
-                        engResults.append(result)
-                if engResults != []:
-                    if len(engResults) == 1:
-                        await wiki_page_embed(baseURL, bufferMsg, client, engResults[0])
-                    else:
-                        em = discord.Embed(title="Factorio Wiki",
-                                        url=f"https://{baseURL}/index.php?search={searchterm}".replace(' ', '_'),
-                                        color=discord.Colour.gold())
-                        for result in engResults:
-                            url = f"https://{baseURL}/{result['title'].replace(' ', '_')}"
-                            em.add_field(name = result["title"], value = f"[Read More]({url})")
-                        await bufferMsg.edit(embed=em)
-
-                else:
-                    em = discord.Embed(title="Error",
-                                       description=f"Could not find English results for \"{searchterm.title()}\" in wiki.",
-                                       color=discord.Colour.red())
-                    await bufferMsg.edit(embed=em)
-
-async def wiki_page_embed(baseURL, bufferMsg, client, result):
-    title = result["title"]
-    url = f"https://{baseURL}/" + title.replace(" ", "_")
-    paragraphs = str.split(await get_wiki_page_safe(client, WIKI_API_URL, title), "\n")
-    try: intropar = [par for par in paragraphs if par != '' and par[0] != "{" and par[0] != "<"][0]
-    except IndexError: intropar = paragraphs[1]
-    formatted = linkEx.sub(
-                    lambda m: f"[{m[2] or m[1]}](https://{baseURL}/{m[1].replace(' ', '_')})",
-                    intropar)
-    formatted = formatted.replace("'", "")
-    em = discord.Embed(title=title,
-                    url=url,
-                    description=formatted,
-                    color=discord.Colour.green())
-    if "Infobox" in paragraphs[0]:
-        image_url = f"https://{baseURL}/images/{title.replace(' ', '_')}.png"
-        em.set_thumbnail(url=image_url)
-    await bufferMsg.edit(embed=em)
+    await send_lookup(ctx, wiki_search_embed(searchterm), em)
+
+
+async def mod_info_embed(mod: ModInfo) -> discord.Embed:
+    """
+    Returns an embed with the details of an indexed mod, falling back to its summary if they can't be fetched
+    """
+    details = await modPortal.get_mod(mod.name)
+    if details is not None:
+        try:
+            return mod_embed(api_mod(details))
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            logger.warning(f"Unexpected details of mod {mod.name}: {type(e).__name__} {e}")
+    return discord.Embed(title=mod.title,
+                         url=modPortal.mod_url(mod.name),
+                         description=markdownEx.sub(r"\\\1", mod.summary),
+                         colour=discord.Colour.dark_green())
+
+
+async def mod_index_embed(modname: str) -> Tuple[discord.Embed, bool]:
+    """
+    Looks the mod name up in the local mod index.
+    Returns an embed with the result(s), and whether anything was found.
+    """
+    mod = modPortal.resolve(modname)
+    if mod is not None:
+        return await mod_info_embed(mod), True
+
+    results = modPortal.search(modname)
+    if len(results) == 0:
+        em = discord.Embed(title="Error",
+                           description=f"Could not find \"{modname.title()}\" in mod portal.",
+                           colour=discord.Colour.red())
+        return em, False
+    if len(results) == 1:
+        return await mod_info_embed(results[0]), True
+
+    em = discord.Embed(title=f"Search results for \"{modname}\"",
+                       colour=discord.Colour.gold())
+    for result in results:
+        summary = markdownEx.sub(r"\\\1", result.summary)
+        em.add_field(name=f"{result.title} (by {result.owner})",
+                     value=f"{summary} [*Read More*]({modPortal.mod_url(result.name)})")
+    return em, True
+
+
+@singleflight(lambda modname: modname.title())
+async def mod_search_embed(modname: str) -> Tuple[discord.Embed, bool]:
+    """
+    Searches the mod portal for the mod name.
+    Returns an embed with the result(s), and whether anything was found.
+    """
+    if modPortal.loaded:
+        return await mod_index_embed(modname)
+
+    #Get mod search results page
+    status, html = await web.fetch(modPortal.url(f"/?version=1.1&search_order=updated&query={modname.title()}"),
+                                   ttl=MOD_SEARCH_TTL)
+
+    #Error: bad response
+    if status != 200:
+        em = discord.Embed(title="Error",
+                            description="Couldn't reach mods.factorio.com.",
+                            colour=discord.Colour.red())
+        return em, False
+
+    search = await run_parser(parse_mod_search, html, modname)
+
+    #Error: no results
+    if "count" in search:
+        em = discord.Embed(title="Error",
+                            description=f"Could not find \"{modname.title()}\" in mod portal.",
+                            colour=discord.Colour.red())
+        return em, False
+
+    #Single or exactly named result
+    if "mod" in search:
+        return mod_embed(search["mod"]), True
+
+    #Multiple results
+    em = discord.Embed(title=f"Search results for \"{modname}\"",
+                        colour=discord.Colour.gold())
+    for result in search["results"]:
+        summary = markdownEx.sub(r"\\\1", result["summary"])
+        em.add_field(name=f"{result['title']} (by {result['author']})",
+                        value=f"{summary} [*Read More*]({modPortal.url(result['href'])})")
+    return em, True
+
+
+def unique_terms(terms: List[str]) -> List[str]:
+    """
+    Returns the terms without case-insensitive repeats, in order
+    """
+    seen = set()
+    unique = []
+    for term in terms:
+        if term.lower() not in seen:
+            seen.add(term.lower())
+            unique.append(term)
+    return unique
+
+
+def group_embeds(embeds: List[discord.Embed]) -> List[List[discord.Embed]]:
+    """
+    Splits the embeds into as few groups as possible, each within Discord's limits for a single message
+    """
+    groups = []
+    group = []
+    groupLength = 0
+    for em in embeds:
+        if group and (len(group) == MAX_EMBEDS_PER_MESSAGE or groupLength + len(em) > MAX_EMBED_CHARS_PER_MESSAGE):
+            groups.append(group)
+            group = []
+            groupLength = 0
+        group.append(em)
+        groupLength += len(em)
+    if group:
+        groups.append(group)
+    return groups
 
 
 class FactorioCog(commands.Cog):
     def __init__(self, bot):
         super().__init__()
         self.bot = bot
+        self.latestFFF = None
+        self.unavailableFFFs = set()
+        self.poll_fff.start()
+        self.refresh_wiki_index.start()
+        self.refresh_mod_index.start()
         type(self).__name__ = "Factorio Commands"
 
+    def cog_unload(self) -> None:
+        global parserPool
+        self.poll_fff.cancel()
+        self.refresh_wiki_index.cancel()
+        self.refresh_mod_index.cancel()
+        if parserPool is not None:
+            parserPool.shutdown(wait=False, cancel_futures=True)
+            parserPool = None
+
+    @tasks.loop(seconds=RSS_POLL_INTERVAL)
+    async def poll_fff(self):
+        """
+        Keeps track of the latest FFF, posts new ones in the servers' FFF channels and fills the FFF archive
+        """
+        # Any error escaping the loop would stop it for good
+        try:
+            latest = await get_latest_fff()
+            if latest is None:
+                return
+            if self.latestFFF is not None and latest > self.latestFFF:
+                # The feed can be ahead of the post's page, so it's only posted once it can be loaded
+                status, fff = await get_fff(latest)
+                if fff is None:
+                    logger.warning(f"Couldn't load FFF #{latest} (status {status}), retrying on the next poll")
+                    return
+                await self.post_fff(latest, fff)
+            self.latestFFF = latest
+        except Exception:
+            logger.exception("Couldn't poll the factorio.com blog for new FFFs")
+            return
+        try:
+            await self.archive_missing_fff()
+        except Exception:
+            logger.exception("Couldn't archive missing FFFs")
+
+    async def archive_missing_fff(self):
+        """
+        Archives the newest FFF that isn't archived yet, so that the archive fills up a post per poll
+        """
+        archived = {row[0] for row in await sql.fetch("SELECT number FROM fffs")}
+        for number in range(self.latestFFF, 0, -1):
+            if number not in archived and number not in self.unavailableFFFs:
+                try:
+                    status, _ = await get_fff(number)
+                except Exception:
+                    # Old posts can have markup parse_fff doesn't understand
+                    logger.exception(f"Couldn't archive FFF #{number}")
+                    self.unavailableFFFs.add(number)
+                    return
+                # Other errors (e.g. factorio.com being down) are retried on the next poll
+                if status == 404:
+                    self.unavailableFFFs.add(number)
+                return
+
+    @poll_fff.before_loop
+    async def before_poll_fff(self):
+        await self.bot.wait_until_ready()
+
+    @tasks.loop(hours=WIKI_INDEX_REFRESH_INTERVAL)
+    async def refresh_wiki_index(self):
+        await wikiIndex.refresh()
+
+    @tasks.loop(hours=MOD_INDEX_REFRESH_INTERVAL)
+    async def refresh_mod_index(self):
+        await modPortal.refresh()
+
+    async def post_fff(self, number: int, fff: dict):
+        """
+        Posts the given FFF in the FFF channel of every server that has one set
+        """
+        em = fff_embed(number, fff)
+        for settings in guildsettings.allsettings():
+            if settings.fffchannel is None:
+                continue
+            channel = self.bot.get_channel(settings.fffchannel)
+            if channel is None:
+                continue
+            try:
+                await channel.send(embed=em)
+            except discord.HTTPException as e:
+                logger.warning(f"Couldn't post FFF #{number} in channel {settings.fffchannel}: {e}")
+
+    @commands.Cog.listener()
+    async def on_inline_lookup(self, message: discord.Message, wikiTerms: List[str], modTerms: List[str]):
+        """
+        Resolves every [[wiki]] and >>mod<< trigger of a message concurrently, and replies with all results at once.
+        Triggers that aren't found are ignored.
+        """
+        # Cap the amount of lookups a single message can cause
+        wikiTerms = unique_terms(wikiTerms)[:MAX_INLINE_LOOKUPS]
+        modTerms = unique_terms(modTerms)[:MAX_INLINE_LOOKUPS - len(wikiTerms)]
+        lookup = asyncio.gather(wiki_embeds(wikiTerms), *[mod_search_embed(modname) for modname in modTerms],
+                                return_exceptions=True)
+        # Like send_lookup, only show that the bot is typing if the lookups are slow
+        done, _ = await asyncio.wait({lookup}, timeout=PLACEHOLDER_DELAY)
+        if not done:
+            async with message.channel.typing():
+                await asyncio.wait({lookup})
+        wikiResults, *modResults = lookup.result()
+        embeds = []
+        if isinstance(wikiResults, BaseException):
+            logger.error("Couldn't look up inline wiki triggers", exc_info=wikiResults)
+        else:
+            embeds += wikiResults
+        for modname, result in zip(modTerms, modResults):
+            if isinstance(result, BaseException):
+                logger.error(f"Couldn't look up \"{modname}\" in the mod portal", exc_info=result)
+            elif result[1]:
+                embeds.append(result[0])
+        for group in group_embeds(embeds):
+            await message.channel.send(embeds=group)
+
     @commands.hybrid_command(aliases=["linkmod"])
     async def mod(self, ctx: commands.Context, *, modname: str = None):
         """
@@ -238,55 +815,15 @@ class FactorioCog(commands.Cog):
             await ctx.send(embed=em)
             return
         
-        #Create and send search in progress embed
         em = discord.Embed(title=f"Searching for \"{modname.title()}\" in mods.factorio.com...",
                             description="This may take a bit.",
                             colour=discord.Colour.gold())
-        bufferMsg = await ctx.send(embed=em)
-        async with ctx.channel.typing():
-
-            #Get mod search results page
-            response = await get_soup(f"https://mods.factorio.com/?version=1.1&search_order=updated&query={modname.title()}")
-
-            #Error: bad response
-            if response[0] != 200:
-                em = discord.Embed(title="Error",
-                                    description="Couldn't reach mods.factorio.com.",
-                                    colour=discord.Colour.red())
-                await bufferMsg.edit(embed=em) if ctx.prefix is not None else await bufferMsg.delete()
-                return
-        
-            soup = response[1]
-
-            #Error: no results
-            if " 0 " in soup.find("div", class_="grey").string:
-                em = discord.Embed(title="Error",
-                                    description=f"Could not find \"{modname.title()}\" in mod portal.",
-                                    colour=discord.Colour.red())
-                await bufferMsg.edit(embed=em) if ctx.prefix is not None else await bufferMsg.delete()
-                return
+        await send_lookup(ctx, mod_search_embed(modname), em)
 
-            #Multiple results
-            if len(soup.find_all("div", class_="flex-column")) > 1:
-                em = discord.Embed(title=f"Search results for \"{modname}\"",
-                                    colour=discord.Colour.gold())
-                i = 0
-                for result in soup.find_all("div", class_="flex-column"):
-                    if i <= 4:
-                        title = result.find("h2", class_="mb0").find("a")
-                        if title.string.title() == modname.title():
-                            em = mod_embed(result)
-                            break
-                        author = result.find("a", class_="orange").string
-                        summary = markdownEx.sub(r"\\\1", result.find("p", class_="pre-line").string)
-                        em.add_field(name=f"{title.string} (by {author})",
-                                        value=f"{summary} [*Read More*](https://mods.factorio.com/mods{title['href']})")
-                        i += 1
-            #Single result
-            else:
-                em = mod_embed(soup.find("div", class_="flex-column"))
-
-            await bufferMsg.edit(embed=em)
+    @mod.autocomplete("modname")
+    async def mod_autocomplete(self, interaction: discord.Interaction, current: str):
+        return [app_commands.Choice(name=f"{mod.title} (by {mod.owner})"[:100], value=mod.name)
+                for mod in modPortal.complete(current)]
 
     @commands.hybrid_command()
     async def wiki(self, ctx: commands.Context, *, searchterm: str = None):
@@ -295,42 +832,65 @@ class FactorioCog(commands.Cog):
         """
         await process_wiki(ctx, searchterm)
 
-    @commands.hybrid_command()
+    @wiki.autocomplete("searchterm")
+    async def wiki_autocomplete(self, interaction: discord.Interaction, current: str):
+        return [app_commands.Choice(name=title, value=title) for title in wikiIndex.complete(current)]
+
+    @commands.hybrid_group(fallback="show", invoke_without_command=True)
     async def fff(self, ctx: commands.Context, number: str = None):
         """
         Links an fff with the number provided.
         """
-        bufferMsg = None
         if number is not None:
             try:
                 number = int(number)
-                em = await embed_fff(number)
             except ValueError:
                 em = discord.Embed(title="Error",
                                    description="To use the command, you need to input a number.",
                                    colour=discord.Colour.red())
+                await ctx.send(embed=em)
+                return
+            em = discord.Embed(title=f"Searching for FFF #{number}...",
+                               description="This may take a bit.",
+                               colour=discord.Colour.gold())
+            await send_lookup(ctx, self.fff_lookup(number), em)
         else:
             em = discord.Embed(title=f"Searching for latest FFF...",
                                description="This may take a bit.",
                                colour=discord.Colour.gold())
-            bufferMsg = await ctx.send(embed=em)
-            async with ctx.channel.typing():
-                async with aiohttp.ClientSession() as client:
-                    async with client.get("https://www.factorio.com/blog/rss") as resp:
-                        status = resp.status
-                        r = await resp.text()
-                if status == 200:
-                    rss = feedparser.parse(r)
-                    i = 0
-                    entry = rss.entries[i]
-                    while "friday facts" not in entry.title.lower():
-                        i += 1
-                        entry = rss.entries[i]
-                    em = await embed_fff(fffEx.search(entry.title).group(1))
-        if not bufferMsg:
-            await ctx.send(embed=em)
+            await send_lookup(ctx, self.fff_lookup(None), em)
+
+    async def fff_lookup(self, number: Union[int, None]) -> Tuple[discord.Embed, bool]:
+        """
+        Returns the embed of the FFF with the given number, or of the latest FFF if it's None
+        """
+        if number is None:
+            number = self.latestFFF if self.latestFFF is not None else await get_latest_fff()
+            if number is None:
+                em = discord.Embed(title="Error",
+                                   description="Couldn't reach factorio.com.",
+                                   colour=discord.Colour.red())
+                return em, True
+        return await embed_fff(number), True
+
+    @fff.command(name="search")
+    async def fff_search(self, ctx: commands.Context, *, query: str):
+        """
+        Searches the archived FFFs for the given words.
+        """
+        results = await search_fffs(query)
+        if len(results) == 0:
+            em = discord.Embed(title="Error",
+                               description=f"Could not find \"{query}\" in any archived FFF.",
+                               colour=discord.Colour.red())
         else:
-            await bufferMsg.edit(embed=em)
+            em = discord.Embed(title=f"FFF search results for \"{query}\"",
+                               colour=discord.Colour.gold())
+            for number, title, snippet in results:
+                em.add_field(name=title,
+                             value=f"{snippet} [*Read More*](https://factorio.com/blog/post/fff-{number})",
+                             inline=False)
+        await ctx.send(embed=em)
 
 
 async def setup(bot):
@@ -18,10 +18,10 @@ async def faqdb(ctx: commands.Context, query: str = None, keys: bool = False) ->
     Searches the database for FAQs according to parameters given
     """
     if keys:
-        return [result[0] for result in await sql.fetch("SELECT title FROM faq WHERE serverid=? ORDER BY title", str(ctx.message.guild.id))]
+        return [result[0] for result in await sql.fetch("SELECT title FROM faq WHERE serverid=? ORDER BY title", ctx.message.guild.id)]
     if query is None:
-        return await sql.fetch("SELECT * FROM faq WHERE serverid=?", str(ctx.message.guild.id))
-    faqRow = await sql.fetch("SELECT * FROM faq WHERE serverid=? AND title=?", str(ctx.message.guild.id), query)
+        return await sql.fetch("SELECT * FROM faq WHERE serverid=?", ctx.message.guild.id)
+    faqRow = await sql.fetch("SELECT * FROM faq WHERE serverid=? AND title=?", ctx.message.guild.id, query)
     return faqRow[0]
 
 
@@ -115,9 +115,9 @@ class FAQCog(commands.Cog):
     @tasks.loop(hours=3)
     async def update_faq_cache(self):
         self.tags = {}
-        servers = [int(result[0]) for result in await sql.fetch("SELECT serverid FROM servers")]
+        servers = [result[0] for result in await sql.fetch("SELECT serverid FROM servers")]
         for server in servers:
-            self.tags[server] = [result[0] for result in await sql.fetch("SELECT title FROM faq WHERE serverid=? ORDER BY title", str(server))]
+            self.tags[server] = [result[0] for result in await sql.fetch("SELECT title FROM faq WHERE serverid=? ORDER BY title", server)]
 
     @commands.hybrid_group(name="faq", aliases=["tag", "tags", "faw", "FAQ"], fallback="list", with_app_command=True)
     async def faq_command(self, ctx: commands.Context, *, query: str = ""):
@@ -195,11 +195,11 @@ class FAQCog(commands.Cog):
         if updatebool:
             if not existed:
                 await sql.execute("INSERT INTO faq VALUES(?, ?, ?, ?, ?, ?, ?)",
-                                  str(ctx.message.guild.id), title, content, image, creator, timestamp, None)
+                                  ctx.message.guild.id, title, content, image, creator, timestamp, None)
                 embedTitle = f"Successfully added \"{title.title()}\" to database"
             else:
                 await sql.execute("UPDATE faq SET content=?, image=?, timestamp=? WHERE serverid=? AND title=?",
-                                  content, image, timestamp, str(ctx.message.guild.id), title)
+                                  content, image, timestamp, ctx.message.guild.id, title)
                 embedTitle = f"Successfully edited \"{title.title()}\" in database"
             await ctx.send(embed=await embed_faq(ctx, self.bot, title, embedTitle, discord.Colour.dark_green()))
         await self.update_faq_cache()
@@ -217,8 +217,8 @@ class FAQCog(commands.Cog):
                                  query=title,
                                  title=f"Successfully removed \"{title.title()}\" from FAQ tags.",
                                  color=discord.Colour.red())
-            await sql.execute("DELETE FROM faq WHERE serverid=? AND title=?", str(ctx.message.guild.id), title)
-            await sql.execute("DELETE FROM faq WHERE serverid=? and link=?", str(ctx.message.guild.id), title)
+            await sql.execute("DELETE FROM faq WHERE serverid=? AND title=?", ctx.message.guild.id, title)
+            await sql.execute("DELETE FROM faq WHERE serverid=? and link=?", ctx.message.guild.id, title)
             await ctx.send(embed=em)
         else:
             em = discord.Embed(title="Error",
@@ -241,7 +241,7 @@ class FAQCog(commands.Cog):
                                      bot=self.bot,
                                      query=title,
                                      title=f"Successfully edited \"{title.title()}\" to be a link for \"{link.title()}\"")
-            await sql.execute("INSERT INTO faq (serverid, title, link) VALUES (?, ?, ?)", str(ctx.message.guild.id), title, link)
+            await sql.execute("INSERT OR REPLACE INTO faq (serverid, title, link) VALUES (?, ?, ?)", ctx.message.guild.id, title, link)
             em = discord.Embed(title=f"Successfully added tag \"{title}\" linking to \"{link}\"",
                                colour=discord.Colour.dark_green())
         else:
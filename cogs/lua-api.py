@@ -8,16 +8,22 @@ from discord import app_commands
 from discord.ext import commands
 from discord.ext import tasks
 
+from utils import web
+
 JSON_LUA_API = "https://lua-api.factorio.com/latest/runtime-api.json"
 BASE_API_URL = "https://lua-api.factorio.com/latest/"
+# The API file is large, so it gets more time than other requests
+API_TIMEOUT = aiohttp.ClientTimeout(total=60, connect=5, sock_read=20)
+API_TTL = 60 * 60  # Seconds
 
 flatten_exceptions = ["return_values", "options"]
 
-async def update_api() -> dict:
-    async with aiohttp.ClientSession() as session:
-        async with session.get(JSON_LUA_API) as resp:
-            api = await resp.json()
-            return api
+async def update_api() -> Union[dict, None]:
+    """
+    Returns the runtime API documentation, or None if it couldn't be downloaded
+    """
+    status, api = await web.fetch_json(JSON_LUA_API, ttl=API_TTL, timeout=API_TIMEOUT)
+    return api if status == 200 else None
 
 def flatten_list(listname: str, input: list) -> Union[dict, list]:
     """
@@ -139,6 +145,8 @@ class LuaAPIcog(commands.Cog):
     @tasks.loop(hours=2)
     async def update_api_cache(self):
         api = await update_api()
+        if api is None:
+            return
         flattened_defines = flattendefines(api["defines"])
         self.flattened_defines_strs = [".".join(f) for f in flattened_defines]
         self.api = inspect_dict(api)
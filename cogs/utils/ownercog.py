@@ -1,9 +1,10 @@
-import aiohttp
 import inspect
 
 import discord
 from discord.ext import commands
 
+from utils import sql, web
+
 
 class OwnerCog(commands.Cog):
     def __init__(self, bot):
@@ -23,10 +24,9 @@ class OwnerCog(commands.Cog):
             name = location if not file else location.filename
             url = location if not file else location.url
             if name.lower()[-3:] in ['png', 'jpg', 'gif'] or name.lower()[-4:] in ['jpeg']:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url) as response:
-                        assert response.status == 200
-                        r = await response.read()
+                async with web.get_session().get(url) as response:
+                    assert response.status == 200
+                    r = await response.read()
                 await self.bot.user.edit(avatar=r)
                 em = discord.Embed(title="Successfully changed avatar to:",
                                    colour=discord.Colour.dark_green())
@@ -96,6 +96,58 @@ class OwnerCog(commands.Cog):
                            colour=discord.Colour.dark_green())
         await ctx.send(embed=em)
 
+    @commands.command(name="sqlstats", aliases=["querystats"])
+    @commands.is_owner()
+    async def sql_stats(self, ctx: commands.Context, reset: str = None):
+        """
+        Shows the slowest database statements since startup.
+        Use with "reset" to clear the statistics.
+        """
+        if reset == "reset":
+            sql.reset_stats()
+            em = discord.Embed(title="Successfully reset database statistics.",
+                               colour=discord.Colour.dark_green())
+            await ctx.send(embed=em)
+            return
+        stats = sorted(sql.stats().items(), key=lambda item: item[1].total, reverse=True)
+        if not stats:
+            em = discord.Embed(title="Error",
+                               description="No database statements have run yet.",
+                               colour=discord.Colour.red())
+            await ctx.send(embed=em)
+            return
+        em = discord.Embed(title="Database statistics",
+                           description=f"Slow query threshold: {sql.SLOW_QUERY_THRESHOLD * 1000:g}ms",
+                           colour=discord.Colour.gold())
+        for template, stat in stats[:10]:
+            em.add_field(name=template[:256],
+                         value=f"{stat.count} calls, {stat.total * 1000:.1f}ms total\n"
+                               f"avg {stat.total / stat.count * 1000:.2f}ms, "
+                               f"p95 ≤{stat.percentile(0.95) * 1000:g}ms, max {stat.max * 1000:.1f}ms",
+                         inline=False)
+        await ctx.send(embed=em)
+
+    @commands.command(name="cachestats", aliases=["webstats"])
+    @commands.is_owner()
+    async def cache_stats(self, ctx: commands.Context):
+        """
+        Shows statistics of the web response cache.
+        """
+        stats = web.cache.stats()
+        lookups = stats["hits"] + stats["misses"] + stats["revalidations"]
+        em = discord.Embed(title="Web cache statistics",
+                           colour=discord.Colour.gold())
+        em.add_field(name="Entries", value=f"{stats['entries']} ({stats['size'] / 1024:.0f}KiB)")
+        em.add_field(name="Hits", value=f"{stats['hits']} ({stats['hits'] / lookups if lookups else 0:.0%})")
+        em.add_field(name="Revalidated", value=stats["revalidations"])
+        em.add_field(name="Misses", value=stats["misses"])
+        for host, hostStats in web.host_stats().items():
+            em.add_field(name=host,
+                         value=f"{'Down' if hostStats['down'] else 'Up'}, {hostStats['failures']} failures, "
+                               f"{hostStats['rejected']} rejected",
+                         inline=False)
+        await ctx.send(embed=em)
+
     @set_avatar.error
     async def set_avatar_error_handler(self, ctx, error):
         origerror = getattr(error, 'original', error)
@@ -1,8 +1,7 @@
-import asyncio
 import datetime
+import functools
 import os
 import pytz
-import re
 
 import logging
 from logging.handlers import TimedRotatingFileHandler
@@ -10,7 +9,7 @@ from logging.handlers import TimedRotatingFileHandler
 import discord
 from discord.ext import commands
 
-from utils import customchecks, sql, punishmentshelper
+from utils import customchecks, guildsettings, sql, punishmentshelper, triggers, web
 
 workDir = os.getcwd()
 logDir = os.path.join(workDir, "logs")
@@ -41,36 +40,27 @@ if "UBOT" not in os.environ:
     raise customchecks.NoTokenError()
 
 
-async def initdb():
-    """
-    Initializes the database (makes sure that all tables are present)
-    """
-    tables = [table[0] for table in await sql.fetch("SELECT name FROM sqlite_master WHERE type='table'")]
-    if any(table not in tables for table in ["servers", "faq", "prefixes", "modroles"]):
-        if "servers" not in tables:
-            await sql.execute("CREATE TABLE servers (serverid varchar(18) PRIMARY KEY, joinleavechannel varchar(18), comment text, muteroleid varchar(18))")
-        if "faq" not in tables:
-            await sql.execute("CREATE TABLE faq (serverid varchar(18), title text, content text, image text, creator varchar(18), timestamp timestamptz, link text)")
-        if "prefixes" not in tables:
-            await sql.execute("CREATE TABLE prefixes (serverid varchar(18), prefix text)")
-        if "modroles" not in tables:
-            await sql.execute("CREATE TABLE modroles (serverid varchar(18), roleid varchar(18))")
-        if "mutes" not in tables:
-            await sql.execute("CREATE TABLE mutes (serverid varchar(18), userid varchar(18), until timestamptz)")
-        if "bans" not in tables:
-            await sql.execute("CREATE TABLE bans (serverid varchar(18), userid varchar(18), until timestamptz)")
-
-
 async def get_prefix(bot: commands.AutoShardedBot, message: discord.Message):
     """
     Returns the prefix(es) for the bot
     """
-    prefixes = await sql.fetch("SELECT prefix FROM prefixes WHERE serverid=?", str(message.guild.id))
-    prefixes = [prefix[0] for prefix in [prefix[0] for prefix in prefixes]]
-    return commands.when_mentioned_or(*prefixes)(bot, message) if prefixes else commands.when_mentioned(bot, message)
+    settings = guildsettings.get(message.guild.id)
+    if settings is None:
+        return commands.when_mentioned(bot, message)
+    # Return only the prefix that matched (if any), so discord.py doesn't have to try each one again
+    prefix = settings.match_prefix(message.content, bot.user.id)
+    return prefix if prefix is not None else []
 
 
-bot = commands.AutoShardedBot(command_prefix=get_prefix, intents=intents)
+class UBot(commands.AutoShardedBot):
+    async def close(self):
+        punishmentshelper.scheduler.stop()
+        await super().close()
+        await web.close()
+        await sql.close()
+
+
+bot = UBot(command_prefix=get_prefix, intents=intents)
 
 
 @bot.event
@@ -113,54 +103,30 @@ async def on_ready():
     logger.info("Verifying guilds match DB")
     guilds = bot.guilds
     guildIds = [guild.id for guild in guilds]
-    missingGuildIds = [guildId for guildId in guildIds if len(await sql.fetch("SELECT 1 FROM servers WHERE serverid=?", str(guildId))) == 0]
-    for guildId in missingGuildIds:
-        logger.debug(f"Added guild with id {guildId} to DB")
-        await sql.initserver(guildId)
-    undeletedGuildIds = [guildId[0] for guildId in await sql.fetch("SELECT serverid FROM servers") if int(guildId[0]) not in guildIds]
-    for guildId in undeletedGuildIds:
-        logger.debug(f"Removed guild with id {guildId} from DB")
-        await sql.deleteserver(guildId)
-
-    unfinishedMutes = await sql.fetch("SELECT * FROM mutes")
-    utcnow = pytz.utc.localize(datetime.datetime.utcnow())
-    for serverid, userid, until in unfinishedMutes:
-        if until is None:
-            continue
-        until = datetime.datetime.strptime(until, "%Y-%m-%d %H:%M:%S%z")
-        roleid = (await sql.fetch("SELECT muteroleid FROM servers WHERE serverid=?", serverid))[0][0]
-        guild = bot.get_guild(int(serverid))
-        if roleid is not None:
-            role = guild.get_role(int(roleid))
-        else:
-            role = None
-        member = guild.get_member(int(userid))
-        if utcnow >= until:
-            if member is not None and role is not None:
-                await member.remove_roles(role, reason="Temporary mute ended.")
-            await sql.execute("DELETE FROM mutes WHERE serverid=? AND userid=?", serverid, userid)
-        else:
-            duration = (until - utcnow).total_seconds()
-            asyncio.ensure_future(punishmentshelper.ensure_unmute(guild, int(userid), duration, role, partialDuration=True))
-
-    unfinishedBans = await sql.fetch("SELECT * FROM bans")
-    for serverid, userid, until in unfinishedBans:
-        until = datetime.datetime.strptime(until, "%Y-%m-%d %H:%M:%S%z")
-        guild = bot.get_guild(int(serverid))
-        guildBans = guild.bans()
-        userid = int(userid)
-        async for _, user in guildBans:
-            if user.id == userid:
-                break
-        else:
-            await sql.execute("DELETE FROM bans WHERE serverid=? AND userid=?", serverid, userid)
-            continue
-        if utcnow >= until:
-            user = await guild.unban(user, reason="Temporary ban ended.")
-            await sql.execute("DELETE FROM bans WHERE serverid=? AND userid=?", serverid, userid)
-        else:
-            duration = (until - utcnow).total_seconds()
-            asyncio.ensure_future(punishmentshelper.ensure_unban(guild, user, duration, partialDuration=True))
+    # Errors in the steps below are only logged, so that they can't keep temporary punishments from ending
+    try:
+        missingGuildIds = [guildId for guildId in guildIds if guildsettings.get(guildId) is None]
+        if missingGuildIds:
+            logger.debug(f"Adding guilds with ids {missingGuildIds} to DB")
+            await guildsettings.initservers(missingGuildIds)
+        guildIdSet = set(guildIds)
+        undeletedGuildIds = [guildId for guildId in guildsettings.serverids() if guildId not in guildIdSet]
+        if undeletedGuildIds:
+            logger.debug(f"Removing guilds with ids {undeletedGuildIds} from DB")
+            await guildsettings.deleteservers(undeletedGuildIds)
+    except Exception:
+        logger.exception("Couldn't sync the guilds with the DB")
+
+    try:
+        await punishmentshelper.reconcile_bans(bot)
+    except Exception:
+        logger.exception("Couldn't reconcile temporary bans")
+    # Expired mutes are ended as soon as the scheduler starts
+    try:
+        await punishmentshelper.scheduler.load()
+    except Exception:
+        logger.exception("Couldn't load temporary mutes and bans")
+    punishmentshelper.scheduler.start(functools.partial(punishmentshelper.expire, bot))
 
     logger.info(f"Logged in as: {bot.user.name} - {bot.user.id}")
     logger.info(f"Serving {len(bot.users)} users in {len(guilds)} server{('s' if len(guilds) > 1 else '')}")
@@ -169,18 +135,13 @@ async def on_ready():
 @bot.event
 async def on_guild_join(guild: discord.Guild):
     logger.info(f"Joined server \'{guild.name}\' - {guild.id}")
-    await sql.initserver(guild.id)
+    await guildsettings.initserver(guild.id)
 
 
 @bot.event
 async def on_guild_remove(guild: discord.Guild):
     logger.info(f"Left server \'{guild.name}\' - {guild.id}")
-    await sql.deleteserver(guild.id)
-
-wikiEx = re.compile(r"\[\[(.*?)\]\]")
-negativeWikiEx = re.compile(r"\`[\S\s]*?\[\[(.*?)\]\][\S\s]*?\`")
-modEx = re.compile(r"\>\>(.*?)\<\<")
-negativeModEx = re.compile(r"\`[\S\s]*?\>\>(.*?)\<\<[\S\s]*?\`")
+    await guildsettings.deleteserver(guild.id)
 
 
 @bot.event
@@ -188,16 +149,11 @@ async def on_message(message: discord.Message):
     if not isinstance(message.channel, discord.abc.GuildChannel) and not isinstance(message.channel, discord.Thread) and not isinstance(message.channel, discord.ForumChannel):
         return
     msg = message.content
-    comment = await sql.fetch("SELECT comment FROM servers WHERE serverid=?", str(message.guild.id))
-    comment = comment[0][0] if len(comment) > 0 and str(comment[0]) != "None" else None
-    wikiSearch = None if not wikiEx.search(msg) or negativeWikiEx.search(msg) else wikiEx.search(msg).group(1)
-    modSearch = None if not modEx.search(msg) or negativeModEx.search(msg) else modEx.search(msg).group(1)
-    if wikiSearch or modSearch:
-        ctx = await bot.get_context(message)
-        if wikiSearch:
-            await ctx.invoke(bot.get_command("wiki"), searchterm=wikiSearch)
-        elif modSearch:
-            await ctx.invoke(bot.get_command("linkmod"), modname=modSearch)
+    settings = guildsettings.get(message.guild.id)
+    comment = settings.comment if settings is not None else None
+    wikiTerms, modTerms = triggers.scan(msg)
+    if wikiTerms or modTerms:
+        bot.dispatch("inline_lookup", message, wikiTerms, modTerms)
     else:
         if comment is not None:
             message.content = message.content.split(comment)[0]
@@ -206,55 +162,52 @@ async def on_message(message: discord.Message):
 
 @bot.event
 async def on_member_join(member: discord.Member):
-    joinLeaveRow = await sql.fetch("SELECT joinleavechannel FROM servers WHERE serverid=?", str(member.guild.id))
-    if len(joinLeaveRow) > 0:  # To avoid errors if the bot was the one removed
-        joinLeaveID = joinLeaveRow[0][0]
-        if joinLeaveID is not None:
-            joinLeaveChannel = bot.get_channel(int(joinLeaveID))
-            await joinLeaveChannel.send(f"**Join** - {member.mention}, account created at {member.created_at.isoformat()}.\n"
-                                        f"ID {member.id}. {member.guild.member_count} members.")
-    muteRow = await sql.fetch("SELECT * FROM mutes WHERE userid=?", str(member.id))
+    settings = guildsettings.get(member.guild.id)
+    if settings is None:  # To avoid errors if the bot was the one removed
+        return
+    if settings.joinleavechannel is not None:
+        joinLeaveChannel = bot.get_channel(settings.joinleavechannel)
+        await joinLeaveChannel.send(f"**Join** - {member.mention}, account created at {member.created_at.isoformat()}.\n"
+                                    f"ID {member.id}. {member.guild.member_count} members.")
+    muteRow = await sql.fetch("SELECT * FROM mutes WHERE userid=?", member.id)
     if len(muteRow) > 0:
         muteRow = muteRow[0]
-        roleRow = await sql.fetch("SELECT muteroleid FROM servers WHERE serverid=?",
-                                  str(member.guild.id))
-        if roleRow[0][0] is not None:
-            role = member.guild.get_role(int(roleRow[0][0]))
+        if settings.muteroleid is not None:
+            role = member.guild.get_role(settings.muteroleid)
         else:
             role = None
         if muteRow[2] is not None and role is not None:
             utcnow = pytz.utc.localize(datetime.datetime.utcnow())
             until = datetime.datetime.strptime(muteRow[2], "%Y-%m-%d %H:%M:%S%z")
             if utcnow < until:
-                await member.add_roles(role)  # ensure_unmute is already running
+                await member.add_roles(role)  # The scheduler still ends the mute
         elif role is not None:
             await member.add_roles(role)
 
 
 @bot.event
 async def on_member_remove(member: discord.Member):
-    joinLeaveRow = await sql.fetch("SELECT joinleavechannel FROM servers WHERE serverid=?", str(member.guild.id))
-    if len(joinLeaveRow) > 0:
-        joinLeaveID = joinLeaveRow[0][0]
-        if joinLeaveID is not None:
-            joinLeaveChannel = bot.get_channel(int(joinLeaveID))
-            await joinLeaveChannel.send(f"**Leave** - {member.name}. ID {member.id}.\n"
-                                        f"{member.guild.member_count} members.")
+    settings = guildsettings.get(member.guild.id)
+    if settings is not None and settings.joinleavechannel is not None:
+        joinLeaveChannel = bot.get_channel(settings.joinleavechannel)
+        await joinLeaveChannel.send(f"**Leave** - {member.name}. ID {member.id}.\n"
+                                    f"{member.guild.member_count} members.")
 
 
 @bot.event
 async def on_member_ban(guild: discord.Guild, user: discord.User):
-    joinLeaveRow = await sql.fetch("SELECT joinleavechannel FROM servers WHERE serverid=?", str(guild.id))
-    if len(joinLeaveRow) > 0:
-        joinLeaveID = joinLeaveRow[0][0]
-        if joinLeaveID is not None:
-            joinLeaveChannel = bot.get_channel(int(joinLeaveID))
-            await joinLeaveChannel.send(f"**Ban** - {user.name}, ID {user.id}.\n")
+    settings = guildsettings.get(guild.id)
+    if settings is not None and settings.joinleavechannel is not None:
+        joinLeaveChannel = bot.get_channel(settings.joinleavechannel)
+        await joinLeaveChannel.send(f"**Ban** - {user.name}, ID {user.id}.\n")
 
 
 @bot.event 
 async def setup_hook():
-    await initdb()
+    await sql.connect()
+    await sql.migrate()
+    await guildsettings.load()
+    await web.connect()
 
     hadError = False
     coglist = []
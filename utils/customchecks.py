@@ -7,7 +7,7 @@ import functools
 import discord
 from discord.ext import commands
 
-from . import sql
+from . import guildsettings
 
 
 class NotAModError(commands.CheckFailure):
@@ -30,7 +30,8 @@ def is_mod():
             return False
 
         getter = functools.partial(discord.utils.get, msg.author.roles)
-        modroles = [int(result[0]) for result in await sql.fetch("SELECT roleid FROM modroles WHERE serverid=?", str(ctx.message.guild.id))]
+        settings = guildsettings.get(ctx.message.guild.id)
+        modroles = settings.modroles if settings is not None else set()
         if not any(getter(id=role) is not None for role in modroles):
             raise NotAModError()
             return False
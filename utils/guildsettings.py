@@ -0,0 +1,161 @@
+import logging
+import re
+from typing import Dict, List, Set, Union
+
+from . import sql
+
+logger = logging.getLogger('root')
+
+
+class GuildSettings:
+    """
+    In-memory copy of a server's settings.
+    Only modify it through the functions in this module, which write to the database first.
+    """
+    def __init__(self, serverid: int, prefixes: List[str] = None, comment: str = None,
+                 joinleavechannel: int = None, muteroleid: int = None, modroles: Set[int] = None,
+                 fffchannel: int = None):
+        self.serverid = serverid
+        self.prefixes = prefixes if prefixes is not None else []
+        self.comment = comment
+        self.joinleavechannel = joinleavechannel
+        self.muteroleid = muteroleid
+        self.modroles = modroles if modroles is not None else set()
+        self.fffchannel = fffchannel
+        self._prefixMatcher = None
+        self._prefixMatcherBotID = None
+
+    def match_prefix(self, content: str, botid: int) -> Union[str, None]:
+        """
+        Returns the prefix (or bot mention) the content starts with, or None.
+        Prefixes are tried in the same order as commands.when_mentioned_or would.
+        """
+        if self._prefixMatcher is None or self._prefixMatcherBotID != botid:
+            alternatives = [f"<@{botid}> ", f"<@!{botid}> "] + self.prefixes
+            self._prefixMatcher = re.compile("|".join(re.escape(prefix) for prefix in alternatives))
+            self._prefixMatcherBotID = botid
+        match = self._prefixMatcher.match(content)
+        return match.group(0) if match is not None else None
+
+    def invalidate_prefixes(self):
+        """
+        Makes match_prefix rebuild its matcher on its next call
+        """
+        self._prefixMatcher = None
+
+
+_settings: Dict[int, GuildSettings] = {}
+
+
+async def load():
+    """
+    Loads the settings of every server from the database
+    """
+    settings = {}
+    for serverid, joinleavechannel, comment, muteroleid, fffchannel in await sql.fetch("SELECT serverid, joinleavechannel, comment, muteroleid, fffchannel FROM servers"):
+        settings[serverid] = GuildSettings(serverid, comment=comment, joinleavechannel=joinleavechannel, muteroleid=muteroleid,
+                                           fffchannel=fffchannel)
+    for serverid, prefix in await sql.fetch("SELECT serverid, prefix FROM prefixes ORDER BY rowid"):
+        if serverid in settings:
+            settings[serverid].prefixes.append(prefix)
+    for serverid, roleid in await sql.fetch("SELECT serverid, roleid FROM modroles"):
+        if serverid in settings:
+            settings[serverid].modroles.add(roleid)
+    _settings.clear()
+    _settings.update(settings)
+    logger.debug(f"Loaded settings for {len(settings)} servers")
+
+
+def get(serverid: int) -> Union[GuildSettings, None]:
+    """
+    Returns the settings of the given server ID, or None if it isn't in the database
+    """
+    return _settings.get(serverid)
+
+
+def allsettings() -> List[GuildSettings]:
+    """
+    Returns the settings of all servers in the database
+    """
+    return list(_settings.values())
+
+
+def serverids() -> List[int]:
+    """
+    Returns the IDs of all servers in the database
+    """
+    return list(_settings)
+
+
+async def initservers(serverids: List[int]):
+    """
+    Initializes the settings of the given server IDs with the defaults
+    """
+    await sql.initservers(serverids)
+    for serverid in serverids:
+        _settings[serverid] = GuildSettings(serverid, prefixes=[sql.defaults["prefix"]], comment=sql.defaults["comment"])
+
+
+async def initserver(serverid: int):
+    """
+    Initializes the settings of the given server ID with the defaults
+    """
+    await initservers([serverid])
+
+
+async def deleteservers(serverids: List[int], punishments: bool = True):
+    """
+    Removes all settings of the given server IDs, and their mutes and bans unless punishments is False
+    """
+    await sql.deleteservers(serverids, punishments)
+    for serverid in serverids:
+        _settings.pop(serverid, None)
+
+
+async def deleteserver(serverid: int, punishments: bool = True):
+    """
+    Removes all settings of the given server ID, and its mutes and bans unless punishments is False
+    """
+    await deleteservers([serverid], punishments)
+
+
+async def add_prefix(serverid: int, prefix: str):
+    await sql.execute("INSERT INTO prefixes VALUES(?, ?)", serverid, prefix)
+    _settings[serverid].prefixes.append(prefix)
+    _settings[serverid].invalidate_prefixes()
+
+
+async def remove_prefix(serverid: int, prefix: str):
+    await sql.execute("DELETE FROM prefixes WHERE serverid=? AND prefix=?", serverid, prefix)
+    _settings[serverid].prefixes.remove(prefix)
+    _settings[serverid].invalidate_prefixes()
+
+
+async def add_modrole(serverid: int, roleid: int):
+    await sql.execute("INSERT INTO modroles VALUES(?, ?)", serverid, roleid)
+    _settings[serverid].modroles.add(roleid)
+
+
+async def remove_modrole(serverid: int, roleid: int):
+    await sql.execute("DELETE FROM modroles WHERE serverid=? AND roleid=?", serverid, roleid)
+    _settings[serverid].modroles.discard(roleid)
+
+
+async def set_comment(serverid: int, comment: Union[str, None]):
+    await sql.execute("UPDATE servers SET comment=? WHERE serverid=?", comment, serverid)
+    _settings[serverid].comment = comment
+
+
+async def set_joinleavechannel(serverid: int, channelid: Union[int, None]):
+    await sql.execute("UPDATE servers SET joinleavechannel=? WHERE serverid=?", channelid, serverid)
+    _settings[serverid].joinleavechannel = channelid
+
+
+async def set_muterole(serverid: int, roleid: Union[int, None]):
+    await sql.execute("UPDATE servers SET muteroleid=? WHERE serverid=?", roleid, serverid)
+    _settings[serverid].muteroleid = roleid
+
+
+async def set_fffchannel(serverid: int, channelid: Union[int, None]):
+    await sql.execute("UPDATE servers SET fffchannel=? WHERE serverid=?", channelid, serverid)
+    _settings[serverid].fffchannel = channelid
@@ -0,0 +1,144 @@
+import aiohttp
+import asyncio
+import bisect
+import json
+import logging
+import os
+from typing import Any, Dict, List, Tuple, Union
+from urllib.parse import quote
+
+from . import web
+
+BASE_URL = os.environ.get("UBOT_MOD_PORTAL_URL", "https://mods.factorio.com").rstrip("/")
+ASSETS_URL = os.environ.get("UBOT_MOD_ASSETS_URL", "https://assets-mod.factorio.com").rstrip("/")
+DETAIL_TTL = 10 * 60  # Seconds
+# The full mod list is several megabytes, and slow to generate
+INDEX_TIMEOUT = aiohttp.ClientTimeout(total=120, connect=5, sock_read=60)
+
+logger = logging.getLogger('root')
+
+
+class ModInfo:
+    """
+    The index's summary of a mod
+    """
+    __slots__ = ("name", "title", "owner", "summary", "downloads")
+
+    def __init__(self, name: str, title: str, owner: str, summary: str, downloads: int):
+        self.name = name
+        self.title = title
+        self.owner = owner
+        self.summary = summary
+        self.downloads = downloads
+
+
+def build_index(text: str) -> Tuple[Dict[str, ModInfo], Dict[str, str], List[str]]:
+    """
+    Builds the index from the body of the mod list API response.
+    Returns the mods by name, the names by lowercase name and title, and the sorted lowercase names and titles.
+    """
+    mods = {}
+    keys = {}
+    for result in json.loads(text)["results"]:
+        mod = ModInfo(result["name"], result.get("title") or result["name"], result.get("owner", ""),
+                      result.get("summary", ""), result.get("downloads_count", 0))
+        mods[mod.name] = mod
+    # Names take precedence over titles, and more downloaded mods over less downloaded ones
+    for mod in sorted(mods.values(), key=lambda mod: -mod.downloads):
+        keys.setdefault(mod.name.lower(), mod.name)
+    for mod in sorted(mods.values(), key=lambda mod: -mod.downloads):
+        keys.setdefault(mod.title.lower(), mod.name)
+    return mods, keys, sorted(keys)
+
+
+class ModPortal:
+    """
+    Client for the mod portal API, with a local index of all mods that is refreshed in the background
+    """
+    def __init__(self, baseURL: str = BASE_URL, assetsURL: str = ASSETS_URL):
+        self.baseURL = baseURL
+        self.assetsURL = assetsURL
+        self.mods: Dict[str, ModInfo] = {}
+        self.keys: Dict[str, str] = {}  # Lowercase name or title -> name
+        self.sortedKeys: List[str] = []
+
+    @property
+    def loaded(self) -> bool:
+        return len(self.mods) > 0
+
+    def url(self, path: str) -> str:
+        return self.baseURL + path
+
+    def mod_url(self, name: str) -> str:
+        return self.url(f"/mod/{quote(name)}")
+
+    def thumbnail_url(self, thumbnail: Union[str, None]) -> Union[str, None]:
+        """
+        Returns the absolute URL of a mod's thumbnail, or None if the mod only has the default one
+        """
+        if not thumbnail or thumbnail == "/assets/.thumb.png":
+            return None
+        return self.assetsURL + thumbnail
+
+    async def refresh(self) -> bool:
+        """
+        Rebuilds the index from the mod list. Keeps the previous index if that fails.
+        Returns whether the index was rebuilt.
+        """
+        status, text = await web.fetch(self.url("/api/mods"), {"page_size": "max"}, timeout=INDEX_TIMEOUT)
+        if status != 200:
+            logger.warning(f"Couldn't refresh the mod index from {self.baseURL} (status {status})")
+            return False
+        try:
+            # The full mod list isn't decoded on the event loop
+            self.mods, self.keys, self.sortedKeys = await asyncio.to_thread(build_index, text)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Couldn't refresh the mod index from {self.baseURL}: unexpected response ({type(e).__name__} {e})")
+            return False
+        logger.debug(f"Indexed {len(self.mods)} mods from {self.baseURL}")
+        return True
+
+    def resolve(self, term: str) -> Union[ModInfo, None]:
+        """
+        Returns the mod whose name or title is the term (ignoring case), or None
+        """
+        name = self.keys.get(term.strip().lower())
+        return self.mods[name] if name is not None else None
+
+    def search(self, term: str, limit: int = 5) -> List[ModInfo]:
+        """
+        Returns up to limit mods whose name or title contains the term, most downloaded first
+        """
+        term = term.strip().lower()
+        names = {name for key, name in self.keys.items() if term in key}
+        return sorted((self.mods[name] for name in names), key=lambda mod: -mod.downloads)[:limit]
+
+    def complete(self, current: str, limit: int = 25) -> List[ModInfo]:
+        """
+        Returns up to limit mods whose name or title starts with current, followed by ones containing it
+        """
+        current = current.strip().lower()
+        names = []
+        i = bisect.bisect_left(self.sortedKeys, current)
+        while i < len(self.sortedKeys) and len(names) < limit and self.sortedKeys[i].startswith(current):
+            if self.keys[self.sortedKeys[i]] not in names:
+                names.append(self.keys[self.sortedKeys[i]])
+            i += 1
+        if len(names) < limit and current:
+            for mod in self.search(current, limit):
+                if mod.name not in names:
+                    names.append(mod.name)
+                    if len(names) == limit:
+                        break
+        return [self.mods[name] for name in names]
+
+    async def get_mod(self, name: str) -> Union[Dict[str, Any], None]:
+        """
+        Returns the full details of the mod from the API, or None if it doesn't exist or the portal couldn't be reached
+        """
+        try:
+            status, mod = await web.fetch_json(self.url(f"/api/mods/{quote(name)}/full"), ttl=DETAIL_TTL)
+        except ValueError as e:
+            logger.warning(f"Unexpected response for mod {name} from {self.baseURL}: {e}")
+            return None
+        return mod if status == 200 and isinstance(mod, dict) else None
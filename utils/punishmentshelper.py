@@ -1,11 +1,13 @@
 import asyncio
 import datetime
+import heapq
 import humanfriendly
-from . import sql
+import logging
+from . import guildsettings, sql
 
 import discord
 
-from typing import Union
+from typing import Awaitable, Callable, Dict, List, Set, Tuple, Union
 
 
 async def lazily_fetch_member(guild: discord.Guild, user_id: int):
@@ -15,35 +17,194 @@ async def lazily_fetch_member(guild: discord.Guild, user_id: int):
         return None
 
 
-async def ensure_unmute(server: discord.Guild, member_id: int, duration: int,
-                        role: discord.Role, partialDuration: bool = False):
+MUTE = "mute"
+BAN = "ban"
+UNTIL_FORMAT = "%Y-%m-%d %H:%M:%S%z"
+# Guilds with more tracked bans than this have their whole ban list fetched, instead of each ban
+BAN_LIST_THRESHOLD = 20
+RECONCILE_CONCURRENCY = 5  # Concurrent Discord requests while reconciling bans
+
+logger = logging.getLogger('root')
+
+
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def parse_until(until: str) -> datetime.datetime:
+    """
+    Parses the until column of the mutes and bans tables
+    """
+    return datetime.datetime.strptime(until, UNTIL_FORMAT)
+
+
+class Scheduler:
     """
-    Sleeps for the given duration, then unmutes the member.
-    Also removes the mute row from the db.
+    Ends temporary mutes and bans when they expire.
+    Expiries are kept in a min-heap, and a single task sleeps until the earliest one is due.
+    Cancelled and rescheduled entries are left in the heap, and skipped when they come up.
     """
-    await asyncio.sleep(duration)
-    reason = "Temporary mute " + (f"of {humanfriendly.format_timespan(duration)} " if not partialDuration else "") + "ended."
-    member = await lazily_fetch_member(server, member_id)
-    if member is not None:
+    def __init__(self, clock: Callable[[], datetime.datetime] = utcnow):
+        self.clock = clock
+        self.heap: List[Tuple[datetime.datetime, str, int, int]] = []
+        self.entries: Dict[Tuple[str, int, int], datetime.datetime] = {}
+        self.expire: Union[Callable[[str, int, int], Awaitable], None] = None
+        self.task: Union[asyncio.Task, None] = None
+        self.wakeup = asyncio.Event()
+
+    def schedule(self, kind: str, serverid: int, userid: int, until: datetime.datetime):
+        """
+        Schedules the punishment to end at the given time, replacing its previous expiry if there is one
+        """
+        self.entries[(kind, serverid, userid)] = until
+        heapq.heappush(self.heap, (until, kind, serverid, userid))
+        if self.heap[0][0] == until:
+            self.wake()
+
+    def cancel(self, kind: str, serverid: int, userid: int):
+        """
+        Makes the punishment not end automatically
+        """
+        self.entries.pop((kind, serverid, userid), None)
+
+    def next_due(self) -> Union[datetime.datetime, None]:
+        """
+        Returns when the next punishment ends, or None if none are scheduled
+        """
+        while self.heap and self.entries.get(self.heap[0][1:]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def wake(self):
+        """
+        Makes the scheduler check for due punishments, e.g. after the clock has been changed
+        """
+        self.wakeup.set()
+
+    async def load(self):
+        """
+        Schedules all temporary punishments from the database
+        """
+        for serverid, userid, until in await sql.fetch("SELECT serverid, userid, until FROM mutes WHERE until IS NOT NULL"):
+            self.schedule(MUTE, serverid, userid, parse_until(until))
+        for serverid, userid, until in await sql.fetch("SELECT serverid, userid, until FROM bans WHERE until IS NOT NULL"):
+            self.schedule(BAN, serverid, userid, parse_until(until))
+
+    def start(self, expire: Callable[[str, int, int], Awaitable]):
+        """
+        Starts ending punishments using expire(kind, serverid, userid), if it isn't running already
+        """
+        self.expire = expire
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            while (due := self.next_due()) is not None and due <= self.clock():
+                _, kind, serverid, userid = heapq.heappop(self.heap)
+                del self.entries[(kind, serverid, userid)]
+                try:
+                    await self.expire(kind, serverid, userid)
+                except Exception:
+                    logger.exception(f"Couldn't end {kind} of user {userid} in server {serverid}")
+            timeout = (due - self.clock()).total_seconds() if due is not None else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+scheduler = Scheduler()
+
+
+async def expire(bot: discord.Client, kind: str, serverid: int, userid: int):
+    """
+    Ends a temporary mute or ban, and removes its row from the db
+    """
+    guild = bot.get_guild(serverid)
+    if kind == MUTE:
+        settings = guildsettings.get(serverid)
+        role = None
+        if guild is not None and settings is not None and settings.muteroleid is not None:
+            role = guild.get_role(settings.muteroleid)
+        member = await lazily_fetch_member(guild, userid) if guild is not None else None
+        if member is not None and role is not None:
+            try:
+                await member.remove_roles(role, reason="Temporary mute ended.")
+            except discord.HTTPException:
+                pass
+        await sql.execute("DELETE FROM mutes WHERE serverid=? AND userid=?", serverid, userid)
+    else:
+        if guild is not None:
+            try:
+                await guild.unban(discord.Object(userid), reason="Temporary ban ended.")
+            except discord.NotFound:
+                pass
+        await sql.execute("DELETE FROM bans WHERE serverid=? AND userid=?", serverid, userid)
+
+
+async def banned_userids(guild: discord.Guild, userids: List[int]) -> Set[int]:
+    """
+    Returns which of the user IDs are banned in the guild
+    """
+    if len(userids) > BAN_LIST_THRESHOLD:
+        return {entry.user.id async for entry in guild.bans(limit=None)} & set(userids)
+    banned = set()
+    for userid in userids:
         try:
-            await member.remove_roles(role, reason=reason)
-        except discord.HTTPException:
-            pass
-    await sql.execute("DELETE FROM mutes WHERE serverid=? AND userid=?",
-                      str(server.id), str(member_id))
+            await guild.fetch_ban(discord.Object(userid))
+        except discord.NotFound:
+            continue
+        banned.add(userid)
+    return banned
 
 
-async def ensure_unban(server: discord.Guild, member: Union[discord.Member, discord.User],
-                       duration: int, partialDuration: bool = False):
+async def reconcile_bans(bot: discord.Client):
     """
-    Sleeps for the given duration, then unbans the member.
-    Also removes the ban row from the db.
+    Forgets temporary bans of users that were unbanned while the bot was off, and ends the ones that expired.
+    Guilds are checked concurrently, fetching each guild's ban list at most once.
     """
-    await asyncio.sleep(duration)
-    reason = "Temporary ban " + (f"of {humanfriendly.format_timespan(duration)} " if not partialDuration else "") + "ended."
-    await server.unban(member, reason=reason)
-    await sql.execute("DELETE FROM bans WHERE serverid=? AND userid=?",
-                      str(server.id), str(member.id))
+    rows: Dict[int, List[Tuple[int, str]]] = {}
+    for serverid, userid, until in await sql.fetch("SELECT serverid, userid, until FROM bans"):
+        rows.setdefault(serverid, []).append((userid, until))
+    # discord.py waits out rate limits on its own, this only bounds how many requests are queued at once
+    limiter = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+    now = utcnow()
+
+    async def reconcile_guild(serverid: int, guildRows: List[Tuple[int, str]]):
+        guild = bot.get_guild(serverid)
+        if guild is None:
+            return
+        try:
+            async with limiter:
+                banned = await banned_userids(guild, [userid for userid, _ in guildRows])
+        except discord.HTTPException as e:
+            logger.warning(f"Couldn't check the bans of server {serverid}: {e}")
+            return
+        unbanned = [(serverid, userid) for userid, _ in guildRows if userid not in banned]
+        if unbanned:
+            await sql.executemany_queries(*[("DELETE FROM bans WHERE serverid=? AND userid=?", *row) for row in unbanned])
+            for _, userid in unbanned:
+                scheduler.cancel(BAN, serverid, userid)
+
+        async def end_ban(userid: int):
+            try:
+                async with limiter:
+                    await expire(bot, BAN, serverid, userid)
+            except discord.HTTPException as e:
+                logger.warning(f"Couldn't end temporary ban of user {userid} in server {serverid}: {e}")
+                return
+            scheduler.cancel(BAN, serverid, userid)
+        await asyncio.gather(*[end_ban(userid) for userid, until in guildRows
+                               if userid in banned and until is not None and parse_until(until) <= now])
+
+    await asyncio.gather(*[reconcile_guild(serverid, guildRows) for serverid, guildRows in rows.items()])
 
 
 async def notify(member: discord.Member, punisher: discord.Member, title: str,
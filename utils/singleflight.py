@@ -0,0 +1,25 @@
+import asyncio
+import functools
+from typing import Awaitable, Callable, Dict, Hashable
+
+
+def singleflight(key: Callable[..., Hashable]):
+    """
+    Decorator for coroutine functions that makes concurrent calls with the same key share one execution.
+    key is called with the same arguments as the function, and should normalize them.
+    The shared call keeps running if one of its waiters is cancelled.
+    """
+    def decorator(func: Callable[..., Awaitable]):
+        calls: Dict[Hashable, asyncio.Future] = {}
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            callKey = key(*args, **kwargs)
+            call = calls.get(callKey)
+            if call is None:
+                call = asyncio.ensure_future(func(*args, **kwargs))
+                calls[callKey] = call
+                call.add_done_callback(lambda _: calls.pop(callKey, None))
+            return await asyncio.shield(call)
+        return wrapper
+    return decorator
@@ -1,9 +1,21 @@
 import aiosqlite
+import asyncio
+import contextlib
 import json
 import logging
-from typing import List, Tuple, Union
+import os
+import sys
+import time
+from typing import AsyncIterator, Dict, List, Tuple, Union
 
 DB_FILE = "db.db"
+POOL_SIZE = 4  # Number of read-only connections used by fetch
+WRITE_WINDOW = 0.01  # Seconds to wait for more writes before committing a batch
+MAX_WRITE_BATCH = 500
+# Statements slower than this (in seconds) are logged along with their call site
+SLOW_QUERY_THRESHOLD = float(os.environ.get("UBOT_SLOW_QUERY_THRESHOLD", 0.1))
+# Upper bounds (in seconds) of the latency histogram buckets; the last bucket is unbounded
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
 
 logger = logging.getLogger('root')
 
@@ -19,58 +31,365 @@ class NoDBError(Exception):
 with open("data/defaults.json") as f:
     defaults = json.load(f)
 
+_connections: List[aiosqlite.Connection] = []
+_pool: Union[asyncio.Queue, None] = None
+_writer: Union[aiosqlite.Connection, None] = None
+_writes: Union[asyncio.Queue, None] = None
+_writerTask: Union[asyncio.Task, None] = None
 
-async def execute(query: str, *args: str):
+# (query, args, many) - if many is True, args is a list of parameter tuples for executemany
+Statement = Tuple[str, Union[tuple, List[tuple]], bool]
+
+# Schema migrations, in order. The index of a migration + 1 is the schema version it upgrades to,
+# which is stored in the database's user_version. Never edit a migration after it has been released.
+MIGRATIONS: List[List[str]] = [
+    # 1: Initial schema
+    ["CREATE TABLE IF NOT EXISTS servers (serverid varchar(18) PRIMARY KEY, joinleavechannel varchar(18), comment text, muteroleid varchar(18))",
+     "CREATE TABLE IF NOT EXISTS faq (serverid varchar(18), title text, content text, image text, creator varchar(18), timestamp timestamptz, link text)",
+     "CREATE TABLE IF NOT EXISTS prefixes (serverid varchar(18), prefix text)",
+     "CREATE TABLE IF NOT EXISTS modroles (serverid varchar(18), roleid varchar(18))",
+     "CREATE TABLE IF NOT EXISTS mutes (serverid varchar(18), userid varchar(18), until timestamptz)",
+     "CREATE TABLE IF NOT EXISTS bans (serverid varchar(18), userid varchar(18), until timestamptz)"],
+    # 2: Indexes and uniqueness constraints (keeping the first of any existing duplicates)
+    ["DELETE FROM faq WHERE rowid NOT IN (SELECT MIN(rowid) FROM faq GROUP BY serverid, title)",
+     "DELETE FROM prefixes WHERE rowid NOT IN (SELECT MIN(rowid) FROM prefixes GROUP BY serverid, prefix)",
+     "DELETE FROM modroles WHERE rowid NOT IN (SELECT MIN(rowid) FROM modroles GROUP BY serverid, roleid)",
+     "DELETE FROM mutes WHERE rowid NOT IN (SELECT MIN(rowid) FROM mutes GROUP BY serverid, userid)",
+     "DELETE FROM bans WHERE rowid NOT IN (SELECT MIN(rowid) FROM bans GROUP BY serverid, userid)",
+     "CREATE UNIQUE INDEX faq_serverid_title ON faq (serverid, title)",
+     "CREATE INDEX faq_serverid_link ON faq (serverid, link)",
+     "CREATE UNIQUE INDEX prefixes_serverid_prefix ON prefixes (serverid, prefix)",
+     "CREATE UNIQUE INDEX modroles_serverid_roleid ON modroles (serverid, roleid)",
+     "CREATE UNIQUE INDEX mutes_serverid_userid ON mutes (serverid, userid)",
+     "CREATE INDEX mutes_userid ON mutes (userid)",
+     "CREATE UNIQUE INDEX bans_serverid_userid ON bans (serverid, userid)"],
+    # 3: Store Discord IDs as INTEGER instead of varchar(18)
+    ["CREATE TABLE servers_new (serverid INTEGER PRIMARY KEY, joinleavechannel INTEGER, comment text, muteroleid INTEGER)",
+     "INSERT INTO servers_new SELECT CAST(serverid AS INTEGER), CAST(joinleavechannel AS INTEGER), comment, CAST(muteroleid AS INTEGER) FROM servers",
+     "DROP TABLE servers",
+     "ALTER TABLE servers_new RENAME TO servers",
+     "CREATE TABLE faq_new (serverid INTEGER, title text, content text, image text, creator INTEGER, timestamp timestamptz, link text)",
+     "INSERT INTO faq_new SELECT CAST(serverid AS INTEGER), title, content, image, CAST(creator AS INTEGER), timestamp, link FROM faq",
+     "DROP TABLE faq",
+     "ALTER TABLE faq_new RENAME TO faq",
+     "CREATE UNIQUE INDEX faq_serverid_title ON faq (serverid, title)",
+     "CREATE INDEX faq_serverid_link ON faq (serverid, link)",
+     "CREATE TABLE prefixes_new (serverid INTEGER, prefix text)",
+     "INSERT INTO prefixes_new SELECT CAST(serverid AS INTEGER), prefix FROM prefixes",
+     "DROP TABLE prefixes",
+     "ALTER TABLE prefixes_new RENAME TO prefixes",
+     "CREATE UNIQUE INDEX prefixes_serverid_prefix ON prefixes (serverid, prefix)",
+     "CREATE TABLE modroles_new (serverid INTEGER, roleid INTEGER)",
+     "INSERT INTO modroles_new SELECT CAST(serverid AS INTEGER), CAST(roleid AS INTEGER) FROM modroles",
+     "DROP TABLE modroles",
+     "ALTER TABLE modroles_new RENAME TO modroles",
+     "CREATE UNIQUE INDEX modroles_serverid_roleid ON modroles (serverid, roleid)",
+     "CREATE TABLE mutes_new (serverid INTEGER, userid INTEGER, until timestamptz)",
+     "INSERT INTO mutes_new SELECT CAST(serverid AS INTEGER), CAST(userid AS INTEGER), until FROM mutes",
+     "DROP TABLE mutes",
+     "ALTER TABLE mutes_new RENAME TO mutes",
+     "CREATE UNIQUE INDEX mutes_serverid_userid ON mutes (serverid, userid)",
+     "CREATE INDEX mutes_userid ON mutes (userid)",
+     "CREATE TABLE bans_new (serverid INTEGER, userid INTEGER, until timestamptz)",
+     "INSERT INTO bans_new SELECT CAST(serverid AS INTEGER), CAST(userid AS INTEGER), until FROM bans",
+     "DROP TABLE bans",
+     "ALTER TABLE bans_new RENAME TO bans",
+     "CREATE UNIQUE INDEX bans_serverid_userid ON bans (serverid, userid)"],
+    # 4: Archive of FFF posts (sections is a JSON list of [name, value] pairs)
+    ["CREATE TABLE fffs (number INTEGER PRIMARY KEY, title text, sections text)"],
+    # 5: Channel new FFFs are posted in
+    ["ALTER TABLE servers ADD COLUMN fffchannel INTEGER"],
+    # 6: Full-text index of archived FFFs (rowid is the FFF number)
+    ["CREATE VIRTUAL TABLE fff_search USING fts5(title, body)",
+     "INSERT INTO fff_search (rowid, title, body) SELECT number, title, "
+     "(SELECT group_concat(json_extract(value, '$[0]') || char(10) || json_extract(value, '$[1]'), char(10)) FROM json_each(sections)) "
+     "FROM fffs"]
+]
+
+
+class QueryStats:
+    """
+    Count and latency histogram of a single statement template
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, duration: float):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if duration <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def percentile(self, fraction: float) -> float:
+        """
+        Returns the upper bound of the bucket containing the given percentile (or the maximum, if unbounded)
+        """
+        target = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets[:-1]):
+            seen += count
+            if seen >= target:
+                return LATENCY_BUCKETS[i]
+        return self.max
+
+
+_stats: Dict[str, QueryStats] = {}
+
+
+def stats() -> Dict[str, QueryStats]:
+    """
+    Returns the statistics of every statement template run since startup (or the last reset)
+    """
+    return _stats
+
+
+def reset_stats():
+    _stats.clear()
+
+
+def _callsite() -> str:
+    """
+    Returns the location of the first caller outside this module
+    """
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    if frame is None:
+        return "unknown"
+    return f"{os.path.relpath(frame.f_code.co_filename)}:{frame.f_lineno} ({frame.f_code.co_name})"
+
+
+def _record(query: str, duration: float, callsite: Union[str, None] = None):
     """
-    Executes the given query + args in the database
+    Adds the duration to the statistics of the query, and logs it if it was slow
     """
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute(query, args)
-        await db.commit()
+    template = " ".join(query.split())
+    if template not in _stats:
+        _stats[template] = QueryStats()
+    _stats[template].record(duration)
+    if duration >= SLOW_QUERY_THRESHOLD:
+        logger.warning(f"Slow query ({duration * 1000:.1f}ms) from {callsite or _callsite()}: {template}")
 
 
-async def fetch(query: str, *args: str) -> Union[List[Tuple[str]], None]:
+async def connect(size: int = POOL_SIZE):
+    """
+    Opens the reader connection pool and the writer connection used by every other function in this module
+    """
+    global _pool, _writer, _writes, _writerTask
+    if _pool is not None:
+        return
+    # Transactions on the writer are managed explicitly by _write_loop
+    _writer = await aiosqlite.connect(DB_FILE, isolation_level=None)
+    # In WAL mode readers see the last committed state without waiting for the writer (and vice versa)
+    async with _writer.execute("PRAGMA journal_mode=WAL"):
+        pass
+    _writes = asyncio.Queue()
+    _writerTask = asyncio.create_task(_write_loop(_writer, _writes))
+    pool = asyncio.Queue()
+    for _ in range(size):
+        db = await aiosqlite.connect(f"file:{DB_FILE}?mode=ro", uri=True)
+        _connections.append(db)
+        pool.put_nowait(db)
+    _pool = pool
+    logger.debug(f"Opened a database writer and {size} readers")
+
+
+async def close():
+    """
+    Flushes pending writes, then closes every connection
+    """
+    global _pool, _writer, _writes, _writerTask
+    writer = _writer
+    if _writes is not None:
+        _writes.put_nowait(None)
+        await _writerTask
+    _pool = _writer = _writes = _writerTask = None
+    while _connections:
+        await _connections.pop().close()
+    # Closed last so that it can checkpoint the WAL
+    if writer is not None:
+        await writer.close()
+    logger.debug("Closed database connections")
+
+
+@contextlib.asynccontextmanager
+async def _acquire() -> AsyncIterator[aiosqlite.Connection]:
+    """
+    Borrows a connection from the pool for the duration of the context
+    """
+    if _pool is None:
+        raise NoDBError()
+    pool = _pool
+    db = await pool.get()
+    try:
+        yield db
+    finally:
+        pool.put_nowait(db)
+
+
+async def _write_loop(db: aiosqlite.Connection, writes: asyncio.Queue):
+    """
+    Commits queued writes in groups.
+    Every write that arrives within WRITE_WINDOW of the first one shares its transaction,
+    while each write keeps its own savepoint so a failing one doesn't affect the rest.
+    """
+    closing = False
+    while not closing:
+        item = await writes.get()
+        if item is None:
+            break
+        await asyncio.sleep(WRITE_WINDOW)
+        batch = [item]
+        while not writes.empty() and len(batch) < MAX_WRITE_BATCH:
+            item = writes.get_nowait()
+            if item is None:
+                closing = True
+                break
+            batch.append(item)
+
+        results = []
+        try:
+            await db.execute("BEGIN")
+            for statements, future, callsite in batch:
+                await db.execute("SAVEPOINT write")
+                try:
+                    for query, args, many in statements:
+                        start = time.perf_counter()
+                        if many:
+                            await db.executemany(query, args)
+                        else:
+                            await db.execute(query, args)
+                        _record(query, time.perf_counter() - start, callsite)
+                except Exception as e:
+                    await db.execute("ROLLBACK TO write")
+                    results.append((future, e))
+                else:
+                    results.append((future, None))
+                await db.execute("RELEASE write")
+            start = time.perf_counter()
+            await db.execute("COMMIT")
+            _record("COMMIT", time.perf_counter() - start, "write batch")
+        except Exception as e:
+            logger.exception("Failed to commit a batch of writes")
+            if db.in_transaction:
+                await db.execute("ROLLBACK")
+            results = [(future, e) for _, future, _ in batch]
+
+        for future, error in results:
+            if future is None:
+                if error is not None:
+                    logger.error(f"Unawaited database write failed: {error!r}")
+            elif not future.done():
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+
+
+async def _write(statements: List[Statement], wait: bool):
+    """
+    Queues the statements to be executed atomically by the writer.
+    If wait is True, returns only once they have been committed.
+    """
+    if _writes is None:
+        raise NoDBError()
+    future = asyncio.get_running_loop().create_future() if wait else None
+    _writes.put_nowait((statements, future, _callsite()))
+    if future is not None:
+        await future
+
+
+async def execute(query: str, *args, wait: bool = True):
+    """
+    Executes the given query + args in the database.
+    Writes are committed in groups; with wait=False, returns without waiting for the commit.
+    """
+    await _write([(query, args, False)], wait)
+
+
+async def fetch(query: str, *args) -> Union[List[tuple], None]:
     """
     Returns the result from the given query + args in the database
     """
-    async with aiosqlite.connect(DB_FILE) as db:
-        cursor = await db.execute(query, args)
-        rows = await cursor.fetchall()
+    async with _acquire() as db:
+        start = time.perf_counter()
+        async with db.execute(query, args) as cursor:
+            rows = await cursor.fetchall()
+        _record(query, time.perf_counter() - start)
     return rows
 
 
-async def executemany_queries(*queries: str):
+async def executemany_queries(*queries: str, wait: bool = True):
+    """
+    Executes many queries as a single atomic write
+    """
+    statements = []
+    for query in queries:
+        if type(query) == tuple:
+            statements.append((query[0], query[1:], False))
+        elif type(query) == str:
+            statements.append((query, (), False))
+        else:
+            raise InvalidQueryError()
+    await _write(statements, wait)
+
+
+async def migrate():
+    """
+    Brings the database schema up to date, applying each pending migration atomically
+    """
+    version = (await fetch("PRAGMA user_version"))[0][0]
+    if version > len(MIGRATIONS):
+        logger.warning(f"Database schema version {version} is newer than this version of the bot")
+    for newVersion, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info(f"Migrating database to schema version {newVersion}")
+        # PRAGMA doesn't accept bound parameters
+        await executemany_queries(*migration, f"PRAGMA user_version = {newVersion}")
+
+
+async def initservers(serverids: List[int]):
     """
-    Executes many queries utilizing only one session
+    Initializes the values in the database for all of the given server IDs in one transaction
     """
-    async with aiosqlite.connect(DB_FILE) as db:
-        for query in queries:
-            if type(query) == tuple:
-                await db.execute(query[0], query[1:])
-                await db.commit()
-            elif type(query) == str:
-                await db.execute(query)
-                await db.commit()
-            else:
-                raise InvalidQueryError()
+    if not serverids:
+        return
+    await _write([("INSERT INTO servers (serverid, comment) VALUES (?, ?)",
+                   [(serverid, defaults["comment"]) for serverid in serverids], True),
+                  ("INSERT INTO prefixes VALUES (?, ?)",
+                   [(serverid, defaults["prefix"]) for serverid in serverids], True)], True)
 
 
-async def initserver(serverid: Union[int, str]):
+async def initserver(serverid: int):
     """
     Initializes the values in the database for the given server ID
     """
-    await executemany_queries(
-        ("INSERT INTO servers (serverid, comment) VALUES (?, ?)", str(serverid), defaults["comment"]),
-        ("INSERT INTO prefixes VALUES (?, ?)", str(serverid), defaults["prefix"])
-    )
+    await initservers([serverid])
+
+
+async def deleteservers(serverids: List[int], punishments: bool = True):
+    """
+    Removes all lines refrencing any of the given server IDs from the database in one transaction.
+    With punishments=False, the servers' mutes and bans are kept.
+    """
+    if not serverids:
+        return
+    tables = ["servers", "prefixes", "faq", "modroles"]
+    if punishments:
+        tables += ["mutes", "bans"]
+    args = [(serverid,) for serverid in serverids]
+    await _write([(f"DELETE FROM {table} WHERE serverid=?", args, True) for table in tables], True)
 
 
-async def deleteserver(serverid: Union[int, str]):
+async def deleteserver(serverid: int, punishments: bool = True):
     """
     Removes all lines refrencing the given server ID from the database
     """
-    queries = ["DELETE FROM servers WHERE serverid=?",
-               "DELETE FROM prefixes WHERE serverid=?",
-               "DELETE FROM faq WHERE serverid=?",
-               "DELETE FROM modroles WHERE serverid=?"]
-    await executemany_queries(*[(query, str(serverid)) for query in queries])
+    await deleteservers([serverid], punishments)
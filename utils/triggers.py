@@ -0,0 +1,73 @@
+from typing import List, Tuple
+
+WIKI_OPEN, WIKI_CLOSE = "[[", "]]"
+MOD_OPEN, MOD_CLOSE = ">>", "<<"
+
+
+class _Finder:
+    """
+    Finds the next occurrence of a substring, remembering the last result.
+    Since scan only moves forward, every character is searched at most once per finder.
+    """
+    def __init__(self, text: str, sub: str):
+        self.text = text
+        self.sub = sub
+        self.pos = -1
+
+    def next(self, start: int) -> int:
+        if self.pos != len(self.text) and self.pos < start:
+            self.pos = self.text.find(self.sub, start)
+            if self.pos == -1:
+                self.pos = len(self.text)
+        return self.pos
+
+
+def scan(content: str) -> Tuple[List[str], List[str]]:
+    """
+    Returns the wiki ([[term]]) and mod (>>name<<) triggers in the message, in order,
+    ignoring those inside inline code or code blocks.
+    Runs in linear time.
+    """
+    if WIKI_OPEN not in content and MOD_OPEN not in content:
+        return [], []
+    wikiTerms = []
+    modTerms = []
+    newlines = _Finder(content, "\n")
+    closers = {WIKI_OPEN: _Finder(content, WIKI_CLOSE), MOD_OPEN: _Finder(content, MOD_CLOSE)}
+    results = {WIKI_OPEN: wikiTerms, MOD_OPEN: modTerms}
+    codeFence = 0  # Length of the backtick run that opened the current code span, 0 if not in one
+    pending = []  # Triggers inside a code span that hasn't been closed yet
+    i = 0
+    length = len(content)
+    while i < length:
+        char = content[i]
+        if char == "`":
+            runEnd = i
+            while runEnd < length and content[runEnd] == "`":
+                runEnd += 1
+            run = runEnd - i
+            if codeFence == 0:
+                codeFence = run
+            elif run == codeFence:
+                codeFence = 0
+                pending.clear()
+            i = runEnd
+            continue
+        opener = content[i:i + 2] if char in "[>" else None
+        if opener in closers:
+            start = i + 2
+            close = closers[opener].next(start)
+            if close < length and close < newlines.next(start):
+                term = content[start:close]
+                if term:
+                    if codeFence == 0:
+                        results[opener].append(term)
+                    else:
+                        pending.append((opener, term))
+                i = close + 2
+                continue
+        i += 1
+    # An unclosed backtick run doesn't start a code span
+    for opener, term in pending:
+        results[opener].append(term)
+    return wikiTerms, modTerms
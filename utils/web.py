@@ -0,0 +1,247 @@
+import aiohttp
+import asyncio
+import collections
+import json
+import logging
+import time
+from typing import Any, Dict, Tuple, Union
+from yarl import URL
+
+CONNECTION_LIMIT = 100
+CONNECTION_LIMIT_PER_HOST = 10
+DNS_CACHE_TTL = 300  # Seconds
+KEEPALIVE_TIMEOUT = 30  # Seconds
+TIMEOUT = aiohttp.ClientTimeout(total=30, connect=10, sock_read=20)
+# Deadlines of a single fetch, unless the caller gives its own
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=15, connect=5, sock_read=10)
+CACHE_MAX_SIZE = 32 * 1024 * 1024  # Total characters of cached responses
+HOST_CONCURRENCY = 4  # Concurrent fetches per host
+BREAKER_THRESHOLD = 5  # Consecutive failures after which a host is considered down
+BREAKER_COOLDOWN = 60  # Seconds before a host that is down is tried again
+# Status returned by fetch when the host couldn't be reached and nothing is cached
+UNAVAILABLE = 503
+
+logger = logging.getLogger('root')
+
+
+class NoSessionError(Exception):
+    pass
+
+
+_session: Union[aiohttp.ClientSession, None] = None
+
+
+class CachedResponse:
+    def __init__(self, text: str, expires: float, etag: Union[str, None], lastModified: Union[str, None]):
+        self.text = text
+        self.expires = expires
+        self.etag = etag
+        self.lastModified = lastModified
+
+
+class ResponseCache:
+    """
+    LRU cache of successful responses, bounded by the total size of their bodies
+    """
+    def __init__(self, maxSize: int):
+        self.maxSize = maxSize
+        self.size = 0
+        self.entries: "collections.OrderedDict[str, CachedResponse]" = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def get(self, key: str) -> Union[CachedResponse, None]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: CachedResponse):
+        self.remove(key)
+        if len(entry.text) > self.maxSize:
+            return
+        self.entries[key] = entry
+        self.size += len(entry.text)
+        while self.size > self.maxSize:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted.text)
+
+    def remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.text)
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self.entries), "size": self.size, "hits": self.hits,
+                "misses": self.misses, "revalidations": self.revalidations}
+
+
+cache = ResponseCache(CACHE_MAX_SIZE)
+
+
+class HostPolicy:
+    """
+    Limits the concurrent requests to a host, and acts as its circuit breaker:
+    after BREAKER_THRESHOLD consecutive failures, requests fail fast for BREAKER_COOLDOWN seconds,
+    after which a single request is let through to check whether the host is back.
+    """
+    def __init__(self, host: str):
+        self.host = host
+        self.semaphore = asyncio.Semaphore(HOST_CONCURRENCY)
+        self.failures = 0
+        self.openUntil = 0.0
+        self.probing = False
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        """
+        Returns whether a request to the host may be made now
+        """
+        if self.failures < BREAKER_THRESHOLD:
+            return True
+        if time.monotonic() < self.openUntil or self.probing:
+            self.rejected += 1
+            return False
+        self.probing = True
+        return True
+
+    def succeeded(self):
+        self.failures = 0
+
+    def failed(self):
+        self.failures += 1
+        if self.failures >= BREAKER_THRESHOLD:
+            if self.failures == BREAKER_THRESHOLD:
+                logger.warning(f"Too many failed requests, not contacting {self.host} for {BREAKER_COOLDOWN} seconds")
+            self.openUntil = time.monotonic() + BREAKER_COOLDOWN
+
+
+_hosts: Dict[str, HostPolicy] = {}
+
+
+def host_policy(host: str) -> HostPolicy:
+    policy = _hosts.get(host)
+    if policy is None:
+        policy = _hosts[host] = HostPolicy(host)
+    return policy
+
+
+def host_stats() -> Dict[str, Dict[str, Any]]:
+    """
+    Returns the circuit breaker state of every host that has been contacted
+    """
+    return {host: {"down": policy.failures >= BREAKER_THRESHOLD, "failures": policy.failures,
+                   "rejected": policy.rejected}
+            for host, policy in _hosts.items()}
+
+
+async def connect():
+    """
+    Creates the HTTP session shared by everything that makes web requests
+    """
+    global _session
+    if _session is not None:
+        return
+    connector = aiohttp.TCPConnector(limit=CONNECTION_LIMIT,
+                                     limit_per_host=CONNECTION_LIMIT_PER_HOST,
+                                     ttl_dns_cache=DNS_CACHE_TTL,
+                                     keepalive_timeout=KEEPALIVE_TIMEOUT)
+    _session = aiohttp.ClientSession(connector=connector, timeout=TIMEOUT)
+    logger.debug("Opened HTTP session")
+
+
+async def close():
+    """
+    Closes the shared HTTP session and all of its connections
+    """
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+        logger.debug("Closed HTTP session")
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Returns the shared HTTP session
+    """
+    if _session is None:
+        raise NoSessionError()
+    return _session
+
+
+async def fetch(url: str, params: Dict[str, Any] = None, ttl: float = 0,
+                timeout: aiohttp.ClientTimeout = REQUEST_TIMEOUT) -> Tuple[int, str]:
+    """
+    Returns the response code and body of a GET request to the URL.
+    Successful responses are cached for ttl seconds, and revalidated with their ETag/Last-Modified afterwards.
+    If the host can't be reached (or is considered down), a stale cached response is returned if there is one,
+    and UNAVAILABLE otherwise.
+    """
+    requestURL = URL(url)
+    if params:
+        requestURL = requestURL.update_query(params)
+    key = str(requestURL)
+    entry = cache.get(key) if ttl > 0 else None
+    if entry is not None and entry.expires > time.monotonic():
+        cache.hits += 1
+        return 200, entry.text
+
+    policy = host_policy(requestURL.host)
+    if not policy.allow():
+        return (200, entry.text) if entry is not None else (UNAVAILABLE, "")
+    # When the host is down, the only request allow() lets through is the probe
+    isProbe = policy.failures >= BREAKER_THRESHOLD
+    headers = {}
+    if entry is not None:
+        if entry.etag is not None:
+            headers["If-None-Match"] = entry.etag
+        if entry.lastModified is not None:
+            headers["If-Modified-Since"] = entry.lastModified
+    try:
+        async with policy.semaphore:
+            async with get_session().get(requestURL, headers=headers, timeout=timeout) as resp:
+                status = resp.status
+                if status == 304 and entry is not None:
+                    text = entry.text
+                else:
+                    text = await resp.text()
+                etag = resp.headers.get("ETag")
+                lastModified = resp.headers.get("Last-Modified")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"Request to {requestURL.host} failed: {type(e).__name__} {e}")
+        policy.failed()
+        return (200, entry.text) if entry is not None else (UNAVAILABLE, "")
+    except Exception:
+        # e.g. an undecodable body, or the session being closed
+        logger.exception(f"Request to {requestURL.host} failed")
+        policy.failed()
+        return (200, entry.text) if entry is not None else (UNAVAILABLE, "")
+    finally:
+        # Also if the request was cancelled, so that another probe can be made
+        if isProbe:
+            policy.probing = False
+    if status >= 500:
+        policy.failed()
+        if entry is not None:
+            return 200, entry.text
+    else:
+        policy.succeeded()
+    if status == 304 and entry is not None:
+        cache.revalidations += 1
+        entry.expires = time.monotonic() + ttl
+        return 200, entry.text
+    cache.misses += 1
+    if ttl > 0 and status == 200:
+        cache.put(key, CachedResponse(text, time.monotonic() + ttl, etag, lastModified))
+    return status, text
+
+
+async def fetch_json(url: str, params: Dict[str, Any] = None, ttl: float = 0,
+                     timeout: aiohttp.ClientTimeout = REQUEST_TIMEOUT) -> Tuple[int, Any]:
+    """
+    Like fetch, but decodes the body as JSON (None if the request wasn't successful)
+    """
+    status, text = await fetch(url, params, ttl, timeout)
+    return status, json.loads(text) if status == 200 else None
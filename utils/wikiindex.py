@@ -0,0 +1,96 @@
+import bisect
+import logging
+import re
+from typing import Dict, List, Union
+
+from . import web
+
+logger = logging.getLogger('root')
+
+
+class WikiIndex:
+    """
+    In-memory index of the titles of all pages and redirects of a MediaWiki wiki.
+    Lets exact and case-insensitive lookups skip the search API, and powers autocomplete.
+    """
+    def __init__(self, apiURL: str, namespaces: List[int], exclude: re.Pattern = None):
+        self.apiURL = apiURL
+        self.namespaces = namespaces
+        self.exclude = exclude
+        self.titles: Dict[str, str] = {}  # Lowercase title -> title
+        self.keys: List[str] = []  # Sorted lowercase titles, for prefix lookups
+
+    @property
+    def loaded(self) -> bool:
+        return len(self.titles) > 0
+
+    async def fetch_titles(self, namespace: int, redirects: bool) -> Union[List[str], None]:
+        """
+        Returns the titles of all pages (or all redirects) in the namespace, or None if the wiki couldn't be reached
+        """
+        titles = []
+        params = {
+            "action": "query",
+            "format": "json",
+            "list": "allpages",
+            "apnamespace": namespace,
+            "apfilterredir": "redirects" if redirects else "nonredirects",
+            "aplimit": "max"
+        }
+        while True:
+            try:
+                status, result = await web.fetch_json(self.apiURL, params)
+                if status != 200:
+                    return None
+                titles.extend(page["title"] for page in result["query"]["allpages"])
+                if "continue" not in result:
+                    return titles
+                params.update(result["continue"])
+            except (ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Unexpected allpages response from {self.apiURL}: {type(e).__name__} {e}")
+                return None
+
+    async def refresh(self) -> bool:
+        """
+        Rebuilds the index from the wiki. Keeps the previous index if that fails.
+        Returns whether the index was rebuilt.
+        """
+        titles = {}
+        # Pages take precedence over redirects whose titles only differ in case
+        for redirects in (False, True):
+            for namespace in self.namespaces:
+                namespaceTitles = await self.fetch_titles(namespace, redirects)
+                if namespaceTitles is None:
+                    logger.warning(f"Couldn't refresh the wiki title index of {self.apiURL}")
+                    return False
+                for title in namespaceTitles:
+                    if self.exclude is None or self.exclude.search(title) is None:
+                        titles.setdefault(title.lower(), title)
+        self.titles = titles
+        self.keys = sorted(titles)
+        logger.debug(f"Indexed {len(titles)} wiki titles from {self.apiURL}")
+        return True
+
+    def resolve(self, term: str) -> Union[str, None]:
+        """
+        Returns the title matching the term (ignoring case and underscores), or None
+        """
+        return self.titles.get(term.replace("_", " ").strip().lower())
+
+    def complete(self, current: str, limit: int = 25) -> List[str]:
+        """
+        Returns up to limit titles starting with current, followed by other titles containing it
+        """
+        current = current.replace("_", " ").strip().lower()
+        results = []
+        i = bisect.bisect_left(self.keys, current)
+        while i < len(self.keys) and len(results) < limit and self.keys[i].startswith(current):
+            results.append(self.titles[self.keys[i]])
+            i += 1
+        if len(results) < limit and current:
+            for key in self.keys:
+                if current in key and not key.startswith(current):
+                    results.append(self.titles[key])
+                    if len(results) == limit:
+                        break
+        return results